@@ -7,8 +7,10 @@ the Free Software Foundation, either version 3 of the License, or
 any later version
 """
 
+import hashlib
+import json
 from abc import ABC, abstractmethod
-from typing import Callable
+from typing import Callable, Optional
 
 
 class PlayerException(Exception):
@@ -24,8 +26,12 @@ class Player(ABC):
     """
     播放器基类
     """
+    # 影响播放计划(路径转换)的配置项
+    PLAN_CONFIG_KEYS = ("MappingPath", "NFSPrefer", "ForceMountPath")
+
     def __init__(self, config: dict):
         self._config = config
+        self._plan_version = None
 
     @abstractmethod
     def start_before(self, **kwargs):
@@ -34,8 +40,48 @@ class Player(ABC):
     @abstractmethod
     def play(self, media_path: str, container: str, on_message: Callable[[str, str], None], on_play_begin,
              on_play_in_progress, on_play_end, **kwargs):
+        """
+        播放影片
+        :param kwargs: plan: resolve_plan 预先计算好的播放计划, 传入时跳过路径转换
+        """
         pass
 
+    def resolve_plan(self, media_path: str, container: str) -> Optional[dict]:
+        """
+        预先计算播放计划(路径转换结果), 不支持的播放器返回None
+        :param media_path:
+        :param container:
+        :return:
+        """
+        return None
+
+    def prepare(self, plan: dict):
+        """
+        预先准备下一部可能播放的影片(例如提前挂载共享目录), 不支持的播放器忽略
+        :param plan: resolve_plan 计算的播放计划
+        :return:
+        """
+        pass
+
+    def plan_version(self) -> str:
+        """
+        播放计划的版本, 影响路径转换的配置变化后之前计算的计划失效
+        :return:
+        """
+        if self._plan_version is None:
+            self._snapshot_plan_version()
+        return self._plan_version
+
+    def _snapshot_plan_version(self):
+        """
+        按影响播放计划的配置计算版本, 子类在 start_before 标准化配置后调用
+        只取路径转换相关的配置, 运行中会变化的配置(例如轮换的Auth)和密码不参与
+        :return:
+        """
+        content = json.dumps({key: self._config.get(key) for key in self.PLAN_CONFIG_KEYS},
+                             sort_keys=True, default=str)
+        self._plan_version = hashlib.md5(content.encode("utf-8")).hexdigest()
+
 
 class TVException(Exception):
     """
@@ -157,3 +203,26 @@ class Media(ABC):
     @abstractmethod
     def start(self, **kwargs):
         pass
+
+    @classmethod
+    def create_hub(cls, configs: list):
+        """
+        同一执行器的多个媒体库实例共享的资源, 创建后通过 hub 参数传给每个实例, 不需要共享时返回None
+        :param configs: 使用该执行器的所有媒体库配置
+        :return:
+        """
+        return None
+
+    def stop(self):
+        """
+        停止实例, 释放后台线程等资源(重新加载配置时旧实例会被停止), 没有需要释放的资源时忽略
+        :return:
+        """
+        pass
+
+    def metrics(self) -> dict:
+        """
+        运行指标, 供控制台查看
+        :return:
+        """
+        return {}
@@ -105,16 +105,26 @@ class AppManager:
                 key for key in self.config._config.keys() if key.startswith("Media")
             ]
             media_sections.sort()
+            media_configs = [self.config.get(section_name) for section_name in media_sections]
+            # Instances of the same executor share one hub (worker pools, caches, play lane)
+            hubs = {}
 
-            for section_name in media_sections:
-                media_config = self.config.get(section_name)
+            for section_name, media_config in zip(media_sections, media_configs):
                 if media_config and "Executor" in media_config:
                     try:
-                        module_name, class_name = media_config["Executor"].rsplit(
-                            ".", 1
-                        )
+                        executor = media_config["Executor"]
+                        module_name, class_name = executor.rsplit(".", 1)
                         media_class = dynamic_import(module_name, class_name)
-                        media = media_class(self.player, self.tv, self.av, media_config)
+                        if executor not in hubs:
+                            hubs[executor] = media_class.create_hub(
+                                [c for c in media_configs if c and c.get("Executor") == executor]
+                            )
+                        if hubs[executor] is not None:
+                            media = media_class(
+                                self.player, self.tv, self.av, media_config, hub=hubs[executor]
+                            )
+                        else:
+                            media = media_class(self.player, self.tv, self.av, media_config)
                         media_instances.append(media)
                         media_executor_names.append(media_config["Executor"])
                         logger.info(
@@ -211,6 +221,12 @@ class AppManager:
             self._thread.join(timeout=5)
             self._thread = None
 
+        for media, executor_name in zip(self.media_instances, self.media_executor_names):
+            try:
+                media.stop()
+            except Exception as e:
+                logger.error("Error in %s stop(): %s", executor_name, e)
+
         self.media_instances = []
         self.media_executor_names = []
         self.player = None
@@ -240,6 +256,15 @@ class AppManager:
             "running": state == "running",
         }
 
+    def metrics(self) -> List[Dict]:
+        result = []
+        for media, executor_name in zip(self.media_instances, self.media_executor_names):
+            try:
+                result.append({"executor": executor_name, "metrics": media.metrics()})
+            except Exception as e:
+                logger.error("Error collecting %s metrics: %s", executor_name, e)
+        return result
+
     def is_running(self) -> bool:
         with self._state_lock:
             return self._state == "running"
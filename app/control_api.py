@@ -43,6 +43,10 @@ def create_app(
     def status():
         return jsonify(manager.status())
 
+    @app.route("/api/metrics", methods=["GET"])
+    def metrics():
+        return jsonify({"media": manager.metrics()})
+
     @app.route("/api/start", methods=["POST"])
     def start():
         ok = manager.start()
@@ -7,21 +7,33 @@ the Free Software Foundation, either version 3 of the License, or
 any later version.
 """
 
+import hashlib
 import json
 import logging
-import requests
+import os
+import random
 import websocket
 import threading
 import time
+from datetime import datetime, timezone
 from abstract_classes import *
+from media.emby_cache import RepeatFilter, SessionTable, UserDataTracker
+from media.emby_dispatch import NotificationDispatcher
+from media.emby_http import EmbyHttpClient
+from media.emby_hub import EmbyHub
+from media.emby_library import LibraryIndex
+from media.emby_outbox import Outbox
+from media.emby_progress import ProgressReporter
 
 logger = logging.getLogger(__name__)
 
 
 class Emby(Media):
-    def __init__(self, player: Player, tv: TV, av: AV, config: dict):
+    def __init__(self, player: Player, tv: TV, av: AV, config: dict, hub: EmbyHub = None):
         super().__init__(player, tv, av, config)
         try:
+            # 多个服务器/用户共享的线程池、缓存和播放分组, 单独使用时自己创建一份
+            self._hub = hub if hub is not None else EmbyHub([config])
             self._host = config.get('Host')
             self._user_name = config.get('Username')
             self._password = config.get('Password')
@@ -42,11 +54,104 @@ class Emby(Media):
             self._access_token = None
             self._ws = None
             self._ws_thread = None
+            self._ws_stop = threading.Event()
+            self._ws_opened = False
+            self._last_frame_time = None
+            self._disconnected_at = None
+            self._catch_up_window = config.get("CatchUpWindow", 300)
+            self._reconnect_lock = threading.Lock()
+            self._reconnect_stats = {"connected": False, "reconnects": 0, "total_downtime_s": 0.0,
+                                     "last_downtime_s": None, "caught_up": 0}
             self._play_item = None
-            self._played_info = {}
+            self._repeat_filter = RepeatFilter(
+                timeout=self._repeat_filter_timeout,
+                max_size=config.get("RepeatFilterSize", 1024),
+                path=self._state_path("played") if config.get("RepeatFilterPersist", False) else None)
+            self._persist_token = config.get("PersistToken", True)
+            self._login_lock = threading.Lock()
+            self._login_time = 0
+            self._http = EmbyHttpClient(self._host,
+                                        pool_size=config.get("HttpPoolSize", 4),
+                                        connect_timeout=config.get("HttpConnectTimeout", 3),
+                                        read_timeout=config.get("HttpReadTimeout", 10),
+                                        on_unauthorized=self._relogin)
+            self._http.set_headers(self._get_headers())
+            self._user_data_tracker = UserDataTracker(
+                triggers=config.get("PlayTriggers") or ["Played", "PlayButton", "IsFavorite"])
+            self._item_cache = self._hub.item_cache(self._host,
+                                                    max_size=config.get("ItemCacheSize", 256),
+                                                    ttl=config.get("ItemCacheTtl", 3600))
+            self._sessions_interval = config.get("SessionsInterval", 1500)
+            self._session_table = SessionTable(max_age=config.get("SessionTableMaxAge", 10))
+            self._stop_timeout = config.get("StopTimeout", 3)
+            # 准备由播放器播放的影片, 以及已被立即阻止的会话
+            self._block_stop_window = config.get("BlockStopWindow", 60)
+            self._block_lock = threading.Lock()
+            self._queued_item = None
+            self._stopped_sessions = {}
+            self._stop_executor = self._hub.stop_executor
+            self._notifier = NotificationDispatcher(
+                lambda session_id, header, message: self._session_send_message(session_id, header, message,
+                                                                               timeout_ms=3500),
+                merge_window=config.get("MessageMergeWindow", 0.5),
+                max_pending=config.get("MessageQueueSize", 32))
+            self._frame_dispatcher = self._hub.frame_dispatcher
+            # 写入媒体库的操作(已观看/播放进度)先落盘, 由后台批量发送
+            self._outbox = Outbox(
+                self._state_path("outbox", "db"),
+                {
+                    "played": lambda item_id: self._set_if_watched(item_id, True),
+                    "start": lambda item_id: self._session_playing(self._get_session_id(), item_id),
+                    "progress": lambda item_id, position_ticks, total_ticks: self._session_play_progress(
+                        self._get_session_id(), item_id, position_ticks, total_ticks),
+                    "stopped": lambda item_id, position_ticks: self._session_play_stopped(
+                        self._get_session_id(), item_id, position_ticks),
+                },
+                batch_size=config.get("OutboxBatchSize", 10),
+                max_attempts=config.get("OutboxMaxAttempts", 20))
+            self._library_index = None
+            self._library_page_size = config.get("LibraryIndexPageSize", 500)
+            if config.get("LibraryIndex", False):
+                self._library_index = LibraryIndex(
+                    self._state_path("library", "db"),
+                    lambda item: self._player.resolve_plan(item["Path"], item["Container"])
+                    if self._player is not None else None,
+                    lambda: self._player.plan_version() if self._player is not None else "")
+            self._prefetch_next = config.get("PrefetchNext", True)
+            self._prefetch_stats = {"prefetched": 0, "last_item": None}
+            self._progress_reporter = None
+            if config.get("ReportProgress", False):
+                self._progress_reporter = ProgressReporter(
+                    lambda item_id: self._outbox.put("start", item_id),
+                    lambda item_id, position_ticks, total_ticks: self._outbox.put(
+                        "progress", item_id, position_ticks, total_ticks, coalesce_key="progress:" + item_id),
+                    lambda item_id, position_ticks: self._outbox.put(
+                        "stopped", item_id, position_ticks, coalesce_key="progress:" + item_id),
+                    interval=config.get("ProgressInterval", 30))
+            # 创建成功后才登记, stop() 时注销, 最后一个实例停止后hub关闭线程池
+            self._hub.join()
         except Exception as e:
             raise MediaException(e)
 
+    @classmethod
+    def create_hub(cls, configs: list):
+        """
+        所有emby媒体库共用一个hub
+        :param configs:
+        :return:
+        """
+        return EmbyHub(configs)
+
+    def _state_path(self, name, ext="json"):
+        """
+        本执行器的状态文件路径(位于配置目录), 按服务器和用户区分
+        :param name:
+        :param ext:
+        :return:
+        """
+        key = hashlib.md5("{}|{}".format(self._host, self._user_name).encode("utf-8")).hexdigest()[:8]
+        return os.path.join(os.getenv("CONFIG_DIR", "config"), "emby_{}_{}.{}".format(name, key, ext))
+
     def _get_headers(self):
         """
         获取http的headers
@@ -66,19 +171,20 @@ class Emby(Media):
         :return:
         """
         try:
-            url = "{}/emby/Users/AuthenticateByName".format(self._host)
-            headers = self._get_headers()
             body = {
                 "Username": self._user_name,
                 "Pw": self._password
             }
-            res = requests.post(url=url, headers=headers, json=body)
+            res = self._http.post("/emby/Users/AuthenticateByName", json=body, retry_unauthorized=False)
             if res.status_code == 200:
                 result = res.json()
                 self._access_token = result["AccessToken"]
                 self._user_id = result["User"]["Id"]
+                self._http.set_headers(self._get_headers())
+                self._login_time = time.monotonic()
+                self._save_token()
                 logger.info("Login successful")
-                self._register_device()
+                self._register_device(retry_unauthorized=False)
                 return True
             else:
                 logger.error(f"Failed to login: {res.status_code} {res.text}")
@@ -87,20 +193,73 @@ class Emby(Media):
             logger.error(f"Exception during login: {e}")
             return False
 
-    def _register_device(self):
+    def _relogin(self):
+        """
+        token被服务器拒绝时重新登录
+        :return:
+        """
+        with self._login_lock:
+            # 其他线程刚刚重新登录过
+            if time.monotonic() - self._login_time < 5:
+                return True
+            logger.warning("Access token rejected, login again")
+            return self._login()
+
+    def _load_token(self):
+        """
+        读取缓存的token
+        :return:
+        """
+        if not self._persist_token:
+            return False
+        try:
+            path = self._state_path("token")
+            if not os.path.exists(path):
+                return False
+            with open(path, 'r', encoding='utf-8') as file:
+                token = json.load(file)
+            if token.get("DeviceId") != self._device_id or not token.get("AccessToken"):
+                return False
+            self._access_token = token["AccessToken"]
+            self._user_id = token["UserId"]
+            self._http.set_headers(self._get_headers())
+            logger.info("Use cached access token")
+            return True
+        except Exception as e:
+            logger.error(f"Exception during load access token: {e}")
+        return False
+
+    def _save_token(self):
+        """
+        缓存token, 下次启动时跳过登录
+        :return:
+        """
+        if not self._persist_token:
+            return
+        try:
+            path = self._state_path("token")
+            temp_path = path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump({"AccessToken": self._access_token, "UserId": self._user_id,
+                           "DeviceId": self._device_id}, file)
+            os.replace(temp_path, path)
+        except Exception as e:
+            logger.error(f"Exception during save access token: {e}")
+
+    def _register_device(self, retry_unauthorized: bool = True):
         """
         注册设备
+        :param retry_unauthorized: 返回401时是否重新登录并重试, 登录流程内调用时必须为False(登录锁不可重入)
         :return:
         """
         try:
-            url = "{}/emby/Sessions/Capabilities/Full".format(self._host)
-            headers = self._get_headers()
             body = {
                 "PlayableMediaTypes": ["Audio", "Video"],
                 "SupportsMediaControl": True,
                 "SupportedCommands": ["Play", "Pause", "Stop"]
             }
-            res = requests.post(url=url, headers=headers, json=body)
+            res = self._http.post("/emby/Sessions/Capabilities/Full", json=body,
+                                  retry_unauthorized=retry_unauthorized)
             if res.status_code == 204:
                 logger.debug("Device registered successfully")
             else:
@@ -110,46 +269,218 @@ class Emby(Media):
 
     def _query_item(self, item_ids):
         """
-        查询影片信息
+        查询影片信息(优先使用本地索引和缓存)
         :param item_ids:
         :return:
         """
+        if self._library_index is not None:
+            indexed_item = self._library_index.get(item_ids)
+            if indexed_item is not None:
+                logger.debug(f"library index hit: {item_ids}")
+                return {"Items": [indexed_item]}
+        cached_item = self._item_cache.get(item_ids)
+        if cached_item is not None:
+            logger.debug(f"item cache hit: {item_ids}")
+            return {"Items": [cached_item]}
         try:
-            url = "{}/emby/Items".format(self._host)
-            headers = self._get_headers()
             body = "Fields=Path,MediaStreams&Ids={}".format(item_ids)
-            res = requests.get(url=url, headers=headers, params=body)
+            res = self._http.get("/emby/Items", params=body)
             if res.status_code == 200:
-                return res.json()
+                result = res.json()
+                for item in result.get("Items", []):
+                    self._item_cache.put(item)
+                return result
         except Exception as e:
             logger.error(f"Exception during device registration: {e}")
 
-    def _on_ws_message(self, ws, message):
+    def _query_next_item(self, item_id):
+        """
+        查询下一集(剧集)或下一部分(多部分影片)
+        :param item_id:
+        :return:
+        """
         try:
-            logger.info(f"Emby WebSocket Message Received: {message}")
-            msg = json.loads(message)
-            self._handle_msg(msg)
+            res = self._http.get("/emby/Users/{}/Items/{}".format(self._user_id, item_id),
+                                 endpoint="/emby/Users/{id}/Items/{id}")
+            if res.status_code != 200:
+                logger.error(f"Failed to query item: {res.status_code} {res.text}")
+                return None
+            item = res.json()
+            if item.get("Type") == "Episode" and item.get("SeriesId"):
+                params = {"UserId": self._user_id, "StartItemId": item_id, "Limit": 2, "Fields": "Path"}
+                res = self._http.get("/emby/Shows/{}/Episodes".format(item["SeriesId"]),
+                                     endpoint="/emby/Shows/{id}/Episodes", params=params)
+                if res.status_code == 200:
+                    items = res.json().get("Items", [])
+                    if len(items) > 1 and items[0]["Id"] == item_id:
+                        return items[1]
+            elif item.get("PartCount", 0) > 1:
+                params = {"UserId": self._user_id, "Fields": "Path"}
+                res = self._http.get("/emby/Videos/{}/AdditionalParts".format(item_id),
+                                     endpoint="/emby/Videos/{id}/AdditionalParts", params=params)
+                if res.status_code == 200:
+                    items = res.json().get("Items", [])
+                    if len(items) > 0:
+                        return items[0]
         except Exception as e:
-            logger.error(f"Exception during WebSocket message handling: {e}")
+            logger.error(f"Exception during query next item: {e}")
+        return None
+
+    def _prefetch_next_item(self, item_id):
+        """
+        预取下一集的影片信息并计算播放计划, 支持的播放器会提前准备(例如挂载共享目录)
+        :param item_id:
+        :return:
+        """
+        next_item = self._query_next_item(item_id)
+        if next_item is None or next_item.get("IsFolder") is True or not next_item.get("Path") \
+                or not next_item.get("Container"):
+            return
+        if next_item["Path"].split('.')[-1] in self._exclude_video_ext:
+            return
+        plan = None
+        if self._player is not None:
+            try:
+                plan = self._player.resolve_plan(next_item["Path"], next_item["Container"])
+                if plan is not None:
+                    self._player.prepare(plan)
+            except Exception as e:
+                logger.error(f"Exception during prepare next item: {e}")
+        next_item["Plan"] = plan
+        self._item_cache.put(next_item)
+        self._prefetch_stats["prefetched"] += 1
+        self._prefetch_stats["last_item"] = next_item["Id"]
+        logger.info(f"prefetched next video, path: {next_item['Path']}")
+
+    def _query_library_page(self, start_index, limit):
+        """
+        分页查询媒体库
+        :param start_index:
+        :param limit:
+        :return: (items, total_count)
+        """
+        try:
+            params = {
+                "Recursive": "true",
+                "Fields": "Path",
+                "IncludeItemTypes": "Movie,Episode,Video",
+                "EnableImages": "false",
+                "EnableUserData": "false",
+                "StartIndex": start_index,
+                "Limit": limit,
+            }
+            res = self._http.get("/emby/Users/{}/Items".format(self._user_id), endpoint="/emby/Users/{id}/Items",
+                                 params=params)
+            if res.status_code == 200:
+                result = res.json()
+                return result.get("Items", []), result.get("TotalRecordCount", 0)
+            logger.error(f"Failed to query library: {res.status_code} {res.text}")
+        except Exception as e:
+            logger.error(f"Exception during query library: {e}")
+        return None
+
+    def _sync_library(self):
+        """
+        后台全量同步本地媒体库索引
+        :return:
+        """
+        try:
+            self._library_index.sync(self._query_library_page, self._library_page_size)
+        except Exception as e:
+            logger.error(f"Exception during sync library index: {e}")
+
+    def _on_ws_message(self, ws, message):
+        # 接收线程只分类和入队, 保证及时响应心跳
+        self._last_frame_time = time.time()
+        self._frame_dispatcher.submit(message, self._handle_msg)
 
     def _on_ws_error(self, ws, error):
         logger.error(f"Emby WebSocket Error: {error}")
+        # token被拒绝, 重新登录后由重连流程使用新token
+        if getattr(error, "status_code", None) == 401:
+            self._relogin()
 
     def _on_ws_open(self, ws):
         logger.info("Emby WebSocket Connection Opened")
+        self._ws_opened = True
+        # 订阅会话推送, 维护本地会话表
+        if len(self._block_devices) > 0:
+            ws.send(json.dumps({"MessageType": "SessionsStart", "Data": "0,{}".format(self._sessions_interval)}))
+        # 重连成功, 记录断线时长并补偿断线期间错过的事件
+        with self._reconnect_lock:
+            self._reconnect_stats["connected"] = True
+            if self._disconnected_at is None:
+                return
+            downtime = time.monotonic() - self._disconnected_at
+            self._disconnected_at = None
+            self._reconnect_stats["reconnects"] += 1
+            self._reconnect_stats["total_downtime_s"] += downtime
+            self._reconnect_stats["last_downtime_s"] = downtime
+        logger.info(f"Emby WebSocket reconnected, downtime: {downtime:.1f}s")
+        threading.Thread(target=self._catch_up, args=(self._last_frame_time, downtime), daemon=True).start()
 
     def _on_ws_close(self, ws, close_status_code, close_msg):
         logger.error(f"Emby WebSocket Close, code: {close_status_code}, msg: {close_msg}")
+        self._session_table.invalidate()
+
+    def _catch_up(self, since, downtime):
+        """
+        补偿断线期间错过的播放触发(只补偿最近的一次, 且断线时间不能太长)
+        :param since: 断线前最后收到消息的时间
+        :param downtime: 断线时长
+        :return:
+        """
+        if since is None or self._catch_up_window <= 0:
+            return
+        if downtime > self._catch_up_window:
+            logger.info(f"downtime {downtime:.1f}s exceeds {self._catch_up_window}s, skip catch up")
+            return
+        try:
+            params = {
+                "Recursive": "true",
+                "Fields": "Path",
+                "IncludeItemTypes": "Movie,Episode,Video",
+                "EnableImages": "false",
+                "EnableUserData": "true",
+                "MinDateLastSavedForUser": datetime.fromtimestamp(since - 5, timezone.utc)
+                .strftime("%Y-%m-%dT%H:%M:%S.0000000Z"),
+                "Limit": 10,
+            }
+            res = self._http.get("/emby/Users/{}/Items".format(self._user_id), endpoint="/emby/Users/{id}/Items",
+                                 params=params)
+            if res.status_code != 200:
+                logger.error(f"Failed to query missed changes: {res.status_code} {res.text}")
+                return
+            items = [item for item in res.json().get("Items", []) if "UserData" in item]
+            if len(items) <= 0:
+                return
+            items.sort(key=lambda item: item["UserData"].get("LastPlayedDate", ""), reverse=True)
+            item = items[0]
+            user_data = dict(item["UserData"], ItemId=item["Id"])
+            # 断线期间其他客户端保存进度等也会改变用户数据, 只补偿看起来是选片的变化
+            if not self._user_data_tracker.is_missed_play_intent(user_data, since):
+                logger.info(f"missed user data change is not a play intent, skip catch up, item: {item['Id']}")
+                return
+            logger.info(f"replay missed user data change, item: {item['Id']}")
+            with self._reconnect_lock:
+                self._reconnect_stats["caught_up"] += 1
+            # 与正常消息走同样的处理流程, 保证顺序
+            self._frame_dispatcher.submit(json.dumps({
+                "MessageType": "UserDataChanged",
+                "Data": {"UserId": self._user_id, "UserDataList": [user_data]},
+            }), self._handle_msg)
+        except Exception as e:
+            logger.error(f"Exception during catch up missed changes: {e}")
 
     def _connect_websocket(self):
         """
-        连接ws
+        连接ws, 断开后按带随机抖动的指数退避重连, 直到实例停止
         :return:
         """
-        retry_count = 0  # 重试计数器
-        max_retries = 10  # 最大连续重试次数
+        retry_count = 0  # 连续失败计数器
 
-        while True:
+        while not self._ws_stop.is_set():
+            self._ws_opened = False
             try:
                 # 构造 WebSocket URL
                 websocket_url = (self._host.replace("http", "ws") + "/embywebsocket?api_key="
@@ -165,29 +496,37 @@ class Emby(Media):
                     header=self._get_headers
                 )
 
+                # 创建期间已经停止, stop() 可能没有关闭到这个连接
+                if self._ws_stop.is_set():
+                    break
+
                 logger.info("尝试连接 WebSocket...")
 
                 # 启动 WebSocket，并阻塞等待连接断开
                 self._ws.run_forever(ping_interval=30, ping_timeout=10)
 
-                # 如果 WebSocket 未抛出异常但断开，表示成功连接过
+                if self._ws_stop.is_set():
+                    logger.info("WebSocket 已停止")
+                    break
+
                 logger.warning("WebSocket 已断开，准备清理资源并重连...")
-                retry_count = 0  # 重置重试计数
 
             except (websocket.WebSocketException, BrokenPipeError) as e:
                 # 捕获 WebSocket 和 Broken pipe 异常
                 logger.error(f"WebSocket 异常：{e}，尝试重连...")
-                retry_count += 1
 
             except Exception as e:
                 logger.error(f"未知错误：{e}，尝试重连...")
-                retry_count += 1
 
             finally:
-                # 检查重试次数是否超过最大限制
-                if retry_count > max_retries:
-                    logger.error("超过最大重试次数，停止尝试连接。")
-                    break
+                # 成功连接过则重置重试计数, 并开始记录断线时间
+                if self._ws_opened:
+                    retry_count = 0
+                    with self._reconnect_lock:
+                        self._reconnect_stats["connected"] = False
+                        self._disconnected_at = time.monotonic()
+                else:
+                    retry_count += 1
 
                 # 确保清理资源，关闭 WebSocket 对象
                 if self._ws:
@@ -199,10 +538,13 @@ class Emby(Media):
                     finally:
                         self._ws = None  # 确保释放对象
 
-                # 计算重试等待时间（指数退避算法）
-                wait_time = min(60, (2 ** retry_count))
-                logger.info(f"{wait_time} 秒后重试连接...")
-                time.sleep(wait_time)
+            if self._ws_stop.is_set():
+                break
+            # 计算重试等待时间（带随机抖动的指数退避算法, 避免多个客户端同时重连）
+            wait_time = max(1.0, random.uniform(0, min(60, 2 ** retry_count)))
+            logger.info(f"{wait_time:.1f} 秒后重试连接...")
+            if self._ws_stop.wait(wait_time):
+                break
 
     def _handle_msg(self, msg_data):
         """
@@ -210,6 +552,9 @@ class Emby(Media):
         :param msg_data:
         :return:
         """
+        # 实例已停止(重新加载配置), 队列中剩余的消息不再处理
+        if self._ws_stop.is_set():
+            return
         msg_type = msg_data["MessageType"]
         if msg_type == "Play":
             self._handle_play(msg_data["Data"])
@@ -217,13 +562,101 @@ class Emby(Media):
             self._handle_play_state(msg_data["Data"])
         elif msg_type == "UserDataChanged":
             self._handle_user_data_change(msg_data["Data"])
+        elif msg_type == "LibraryChanged":
+            self._handle_library_change(msg_data["Data"])
+        elif msg_type == "Sessions":
+            self._handle_sessions(msg_data["Data"])
+        elif msg_type == "PlaybackStart":
+            self._handle_block_playback(msg_data["Data"])
 
     def _handle_play(self, data):
-        pass
+        """
+        处理投放到本设备的播放命令, 直接播放命令中的影片, 不再经过用户数据变化
+        :param data:
+        :return:
+        """
+        play_command = data.get("PlayCommand", "PlayNow")
+        if play_command != "PlayNow":
+            logger.info(f"unsupported play command: {play_command}")
+            return
+        if data.get("StartPositionTicks"):
+            logger.debug(f"start position is not supported, play from beginning: {data['StartPositionTicks']}")
+        # 播放列表中第一个可播放的影片
+        for item_id in data.get("ItemIds", []):
+            if self._play_item_by_id(item_id):
+                return
+        logger.warning(f"no playable video in play command: {data.get('ItemIds')}")
 
     def _handle_play_state(self, data):
         pass
 
+    def _handle_library_change(self, data):
+        """
+        媒体库变化时使影片缓存失效
+        :param data:
+        :return:
+        """
+        changed_ids = data.get("ItemsUpdated", []) + data.get("ItemsRemoved", [])
+        if len(changed_ids) > 0:
+            self._item_cache.invalidate(changed_ids)
+            logger.debug(f"invalidate item cache: {changed_ids}")
+        # 增量更新本地索引
+        if self._library_index is not None:
+            removed_ids = data.get("ItemsRemoved", [])
+            if len(removed_ids) > 0:
+                self._library_index.remove(removed_ids)
+            upsert_ids = data.get("ItemsAdded", []) + data.get("ItemsUpdated", [])
+            if len(upsert_ids) > 0:
+                params = {"Fields": "Path", "Ids": ",".join(upsert_ids)}
+                res = self._http.get("/emby/Items", params=params)
+                if res.status_code == 200:
+                    count = self._library_index.upsert(res.json().get("Items", []))
+                    logger.debug(f"library index updated, items: {count}")
+
+    def _handle_sessions(self, sessions):
+        """
+        会话推送: 更新会话表, 并检查阻止设备是否已开始串流
+        :param sessions:
+        :return:
+        """
+        self._session_table.replace(sessions)
+        if len(self._block_devices) > 0:
+            for session in sessions:
+                self._handle_block_playback(session)
+
+    def _handle_block_playback(self, session):
+        """
+        阻止设备开始串流准备由播放器播放的影片时, 立即阻止
+        :param session:
+        :return:
+        """
+        if session.get("DeviceName") not in self._block_devices:
+            return
+        now_playing_item = session.get("NowPlayingItem")
+        if not now_playing_item:
+            return
+        with self._block_lock:
+            queued_item = self._queued_item
+        if (queued_item is None or now_playing_item.get("Id") != queued_item[0]
+                or time.monotonic() - queued_item[1] > self._block_stop_window):
+            return
+        with self._block_lock:
+            if self._stopped_sessions.get(session["Id"]) == queued_item[0]:
+                return
+            self._stopped_sessions[session["Id"]] = queued_item[0]
+        logger.info(f"block device {session['DeviceName']} start playing, stop it at once")
+        self._stop_executor.submit(self._session_playing_stop, session["Id"], self._stop_timeout)
+
+    def _queue_item(self, item_id):
+        """
+        记录准备由播放器播放的影片
+        :param item_id:
+        :return:
+        """
+        with self._block_lock:
+            self._queued_item = (item_id, time.monotonic())
+            self._stopped_sessions = {}
+
     def _handle_user_data_change(self, data):
         """
         处理播放用户数据
@@ -233,74 +666,110 @@ class Emby(Media):
         if self._user_id == data["UserId"]:
             user_data_list = data["UserDataList"]
             user_data = user_data_list[0]
-            # 防止重复播放
-            if (user_data["ItemId"] in self._played_info
-                    and time.time() - self._played_info[user_data["ItemId"]] <= self._repeat_filter_timeout):
-                self.on_message("Warning", "{}s 内不允许播放相同的影片".format(self._repeat_filter_timeout))
+            # 只处理切换已播放、点击播放按钮等选片操作, 其他用户数据变化直接忽略
+            if not self._user_data_tracker.is_play_intent(user_data):
+                logger.debug(f"ignore user data change, item: {user_data['ItemId']}")
                 return
-            item_infos = self._query_item(user_data["ItemId"])
-            if item_infos is not None and "Items" in item_infos and len(item_infos["Items"]) > 0:
-                for item in item_infos["Items"]:
-                    path = item["Path"]
-                    if item["IsFolder"] is True:
-                        continue
-                    if path.split('.')[-1] in self._exclude_video_ext:
-                        logger.info(f"exclude video, path: {path}")
-                        continue
-                    self._play_item = item
-                    logger.info(f"prepare to play this video, path: {path}")
-                    self._run_player()
-                    return
-                self._play_item = None
+            self._play_item_by_id(user_data["ItemId"])
+
+    def _play_item_by_id(self, item_id):
+        """
+        查询影片并调用播放器播放
+        :param item_id:
+        :return: 是否找到可播放的影片
+        """
+        # 防止重复播放
+        if self._repeat_filter.contains(item_id):
+            self.on_message("Warning", "{}s 内不允许播放相同的影片".format(self._repeat_filter_timeout))
+            return True
+        item_infos = self._query_item(item_id)
+        if item_infos is not None and "Items" in item_infos and len(item_infos["Items"]) > 0:
+            for item in item_infos["Items"]:
+                path = item["Path"]
+                if item["IsFolder"] is True:
+                    continue
+                if path.split('.')[-1] in self._exclude_video_ext:
+                    logger.info(f"exclude video, path: {path}")
+                    continue
+                self._play_item = item
+                self._queue_item(item["Id"])
+                logger.info(f"prepare to play this video, path: {path}")
+                self._run_player()
+                return True
+            self._play_item = None
+        return False
+
+    def _resync_sessions(self):
+        """
+        通过REST重新同步会话表
+        :return:
+        """
+        res = self._http.get("/emby/Sessions")
+        if res.status_code == 200:
+            logger.debug("get sessions successfully")
+            self._session_table.replace(res.json(), pushed=False)
+            return True
+        logger.error(f"Failed to get sessions: {res.status_code} {res.text}")
+        return False
 
     def _get_all_sessions(self):
         """
-        获取所有session
+        获取所有session(优先使用websocket推送的会话表, 过期时才重新同步)
         :return:
         """
         try:
-            self._block_sessions.clear()
-            self._session = None
             if len(self._block_devices) <= 0:
+                self._block_sessions = []
+                self._session = None
                 return True
-            url = "{}/emby/Sessions".format(self._host)
-            headers = self._get_headers()
-            res = requests.get(url=url, headers=headers)
-            if res.status_code == 200:
-                logger.debug("get sessions successfully")
-                result = res.json()
-                for session in result:
-                    for block_session in self._block_devices:
-                        if session["DeviceName"] == block_session:
-                            self._block_sessions.append(session)
-                            break
-                        elif session["DeviceName"] == self._device:
-                            self._session = session
-                            break
-                if len(self._block_sessions) < len(self._block_devices):
-                    logger.warning("not all block devices find their sessions")
-                return self._session is not None
-            else:
-                logger.error(f"Failed to get sessions: {res.status_code} {res.text}")
+            resynced = False
+            if self._session_table.is_stale():
+                if not self._resync_sessions():
+                    return False
+                resynced = True
+            own_sessions = self._session_table.get(self._device)
+            if len(own_sessions) <= 0 and not resynced:
+                # 会话表中还没有本设备, 重新同步一次
+                if not self._resync_sessions():
+                    return False
+                own_sessions = self._session_table.get(self._device)
+            block_sessions = []
+            for block_device in self._block_devices:
+                block_sessions.extend(self._session_table.get(block_device))
+            self._block_sessions = block_sessions
+            self._session = own_sessions[0] if len(own_sessions) > 0 else None
+            if len(self._block_sessions) < len(self._block_devices):
+                logger.warning("not all block devices find their sessions")
+            return self._session is not None
         except Exception as e:
             logger.error(f"Exception during get sessions: {e}")
         return False
 
-    def _session_playing_stop(self, session_id):
+    def _get_session_id(self):
+        """
+        本设备的session id
+        :return:
+        """
+        session = self._session
+        return session["Id"] if session is not None else None
+
+    def _session_playing_stop(self, session_id, timeout=None):
         """
         阻止session播放
+        :param session_id:
+        :param timeout: 单次请求的超时时间(秒)
         :return:
         """
         try:
-            url = "{}/emby/Sessions/{}/Playing/Stop".format(self._host, session_id)
-            headers = self._get_headers()
             body = {
                 "Command": "Stop",
                 "SeekPositionTicks": 0,
                 "ControllingUserId": "string"
             }
-            res = requests.post(url=url, headers=headers, json=body)
-            if res. status_code == 204:
+            res = self._http.post("/emby/Sessions/{}/Playing/Stop".format(session_id),
+                                  endpoint="/emby/Sessions/{id}/Playing/Stop", json=body,
+                                  timeout=(timeout, timeout) if timeout else None)
+            if res.status_code == 204:
                 logger.debug("media play stop successfully")
                 return True
             else:
@@ -309,18 +778,17 @@ class Emby(Media):
             logger.error(f"Exception during stop media: {e}")
         return False
 
-    def _session_playing(self, session_id):
+    def _session_playing(self, session_id, item_id):
         """
         报告已播放
         :param session_id:
+        :param item_id:
         :return:
         """
         try:
-            url = "{}/emby/Sessions/Playing".format(self._host)
-            headers = self._get_headers()
             body = {
                 "CanSeek": True,
-                "ItemId": self._play_item["Id"],
+                "ItemId": item_id,
                 "SessionId": session_id,
                 "IsPaused": False,
                 "IsMuted": False,
@@ -328,8 +796,8 @@ class Emby(Media):
                 "PlayMethod": "DirectPlay",
                 "RepeatMode": "RepeatNone"
             }
-            res = requests.post(url=url, headers=headers, json=body)
-            if res.status_code == 204:
+            res = self._http.post("/emby/Sessions/Playing", json=body)
+            if 200 <= res.status_code < 300:
                 logger.debug("notify emby the movie start successfully")
                 return True
             else:
@@ -338,10 +806,12 @@ class Emby(Media):
             logger.error(f"Exception during notify emby the movie start: {e}")
         return False
 
-    def _session_play_progress(self, session_id, position_ticks, total_ticks, is_paused=False, is_muted=False):
+    def _session_play_progress(self, session_id, item_id, position_ticks, total_ticks, is_paused=False,
+                               is_muted=False):
         """
         报告播放进程
         :param session_id:
+        :param item_id:
         :param position_ticks:
         :param total_ticks:
         :param is_paused:
@@ -349,11 +819,9 @@ class Emby(Media):
         :return:
         """
         try:
-            url = "{}/emby/Sessions/Playing/Progress".format(self._host)
-            headers = self._get_headers()
             body = {
                 "CanSeek": True,
-                "ItemId": self._play_item["Id"],
+                "ItemId": item_id,
                 "SessionId": session_id,
                 "IsPaused": is_paused,
                 "IsMuted": is_muted,
@@ -363,8 +831,8 @@ class Emby(Media):
                 "RepeatMode": "RepeatNone",
                 "EventName": "timeupdate"
             }
-            res = requests.post(url=url, headers=headers, json=body)
-            if res.status_code == 204:
+            res = self._http.post("/emby/Sessions/Playing/Progress", json=body)
+            if 200 <= res.status_code < 300:
                 logger.debug("media report progress successfully")
                 return True
             else:
@@ -373,21 +841,20 @@ class Emby(Media):
             logger.error(f"Exception during report progress: {e}")
         return False
 
-    def _session_play_stopped(self, session_id, position_ticks, is_paused=False, is_muted=False):
+    def _session_play_stopped(self, session_id, item_id, position_ticks, is_paused=False, is_muted=False):
         """
         报告播放结束
         :param session_id:
+        :param item_id:
         :param position_ticks:
         :param is_paused:
         :param is_muted:
         :return:
         """
         try:
-            url = "{}/emby/Sessions/Playing/Stopped".format(self._host)
-            headers = self._get_headers()
             body = {
                 "CanSeek": True,
-                "ItemId": self._play_item["Id"],
+                "ItemId": item_id,
                 "SessionId": session_id,
                 "IsPaused": is_paused,
                 "IsMuted": is_muted,
@@ -396,8 +863,8 @@ class Emby(Media):
                 "RepeatMode": "RepeatNone",
                 "EventName": "timeupdate"
             }
-            res = requests.post(url=url, headers=headers, json=body)
-            if res.status_code == 204:
+            res = self._http.post("/emby/Sessions/Playing/Stopped", json=body)
+            if 200 <= res.status_code < 300:
                 logger.debug("notify emby the movie stopped successfully")
                 return True
             else:
@@ -406,19 +873,21 @@ class Emby(Media):
             logger.error(f"Exception during notify emby the movie stopped: {e}")
         return False
 
-    def _set_if_watched(self, watched):
+    def _set_if_watched(self, item_id, watched):
         """
         设置影片是否观看
+        :param item_id:
+        :param watched:
         :return:
         """
         try:
-            url = "{}/emby/Users/{}/PlayedItems/{}".format(self._host, self._user_id, self._play_item["Id"])
-            headers = self._get_headers()
+            path = "/emby/Users/{}/PlayedItems/{}".format(self._user_id, item_id)
+            endpoint = "/emby/Users/{id}/PlayedItems/{id}"
             if watched:
-                res = requests.post(url=url, headers=headers)
+                res = self._http.post(path, endpoint=endpoint)
             else:
-                res = requests.delete(url=url, headers=headers)
-            if res.status_code == 204:
+                res = self._http.delete(path, endpoint=endpoint)
+            if 200 <= res.status_code < 300:
                 logger.debug("set video watched status successfully")
                 return True
             else:
@@ -437,15 +906,14 @@ class Emby(Media):
         :return:
         """
         try:
-            url = "{}/emby/Sessions/{}/Message".format(self._host, session_id)
-            headers = self._get_headers()
             body = {
                 "Id": "Stop",
                 "Text": message,
                 "Header": header,
                 "TimeoutMs": timeout_ms
             }
-            res = requests.post(url=url, headers=headers, json=body)
+            res = self._http.post("/emby/Sessions/{}/Message".format(session_id),
+                                  endpoint="/emby/Sessions/{id}/Message", json=body)
             if res.status_code == 204:
                 logger.debug("send message successfully")
                 return True
@@ -469,12 +937,19 @@ class Emby(Media):
         # 阻止正在串流的播放
         if self._get_all_sessions() is not True:
             return False
+        # 并发发送停止命令, 不等待结果, 每个停止命令有独立的超时时间
+        with self._block_lock:
+            stopped_sessions = dict(self._stopped_sessions)
         for block_session in self._block_sessions:
-            self._session_playing_stop(block_session["Id"])
+            # 已经在开始串流时阻止过
+            if stopped_sessions.get(block_session["Id"]) == self._play_item["Id"]:
+                continue
+            self._stop_executor.submit(self._session_playing_stop, block_session["Id"], self._stop_timeout)
         # 播放
         return self._player.play(self._play_item["Path"], self._play_item["Container"],
                                  self.on_message, self.on_play_begin,
-                                 self.on_play_in_progress, self.on_play_end)
+                                 self.on_play_in_progress, self.on_play_end,
+                                 plan=self._play_item.get("Plan"))
 
     def _connect(self):
         """
@@ -482,9 +957,14 @@ class Emby(Media):
         :return:
         """
         if self._access_token is None:
-            if not self._login():
+            if self._load_token():
+                # 使用缓存的token直接连接, 设备注册放到后台, token无效时会自动重新登录
+                threading.Thread(target=self._register_device, daemon=True).start()
+            elif not self._login():
                 logger.error("Login failed. Unable to connect to emby.")
                 return
+        if self._library_index is not None:
+            threading.Thread(target=self._sync_library, daemon=True).start()
         self._ws_thread = threading.Thread(target=self._connect_websocket)
         self._ws_thread.daemon = True
         self._ws_thread.start()
@@ -492,13 +972,13 @@ class Emby(Media):
 
     def on_message(self, header, message):
         """
-        消息回调事件
+        消息回调事件(异步发送, 立即返回)
         :param header:
         :param message:
         :return:
         """
         for block_session in self._block_sessions:
-            self._session_send_message(block_session["Id"], header, message, timeout_ms=3500)
+            self._notifier.dispatch(block_session["Id"], header, message)
 
     def on_play_begin(self, **kwargs):
         """
@@ -507,11 +987,13 @@ class Emby(Media):
         :return:
         """
         # 记录下此时的播放时间
-        self._played_info[self._play_item["Id"]] = time.time()
-        for block_session in self._block_sessions:
-            # # 报告已开始
-            # self._session_playing(self._session["Id"])
-            pass
+        self._repeat_filter.add(self._play_item["Id"])
+        # 报告已开始
+        if self._progress_reporter is not None:
+            self._progress_reporter.begin(self._play_item["Id"])
+        # 后台预取下一集/下一部分
+        if self._prefetch_next:
+            threading.Thread(target=self._prefetch_next_item, args=(self._play_item["Id"],), daemon=True).start()
         # 然后通知tv,av
         if self._tv is not None:
             try:
@@ -530,33 +1012,28 @@ class Emby(Media):
         :param kwargs:
         :return:
         """
-        # position_ticks = kwargs["position_ticks"]
-        # total_ticks = kwargs["total_ticks"]
-        # for block_session in self._block_sessions:
-        #     self._session_play_progress(block_session["Id"], position_ticks, total_ticks)
-        pass
+        # 只记录最新进度, 由后台线程合并上报
+        if self._progress_reporter is not None:
+            self._progress_reporter.update(kwargs["position_ticks"], kwargs["total_ticks"])
 
     def on_play_end(self, **kwargs):
         """
         播放结束事件
         :return:
         """
-        # 删掉播放很久的影片信息
-        played_info_copy = self._played_info.copy()
-        now_time = time.time()
-        for item_id, last_played_time in played_info_copy.items():
-            if now_time - last_played_time > self._repeat_filter_timeout:
-                self._played_info.pop(item_id)
         # 报告结束
         position_ticks = kwargs["position_ticks"]
         total_ticks = kwargs["total_ticks"]
-        # for block_session in self._block_sessions:
-        #     self._session_play_stopped(block_session["Id"], position_ticks)
+        if self._progress_reporter is not None:
+            self._progress_reporter.end(position_ticks, total_ticks)
         # 设置影片已播放(观看超过70%设置为已观看)
         if total_ticks >= 6000000000 and position_ticks >= 0.7 * total_ticks:
-            self._set_if_watched(True)
+            try:
+                self._outbox.put("played", self._play_item["Id"], coalesce_key="played:" + self._play_item["Id"])
+            except Exception as e:
+                logger.error(f"Exception during set video watched: {e}")
         # else:
-        #     self._set_if_watched(False)
+        #     self._set_if_watched(self._play_item["Id"], False)
 
         # 通知av,tv
         if self._tv is not None:
@@ -570,6 +1047,8 @@ class Emby(Media):
             except Exception as e:
                 logger.error(f"Exception during av play end: {e}")
         self._play_item = None
+        with self._block_lock:
+            self._queued_item = None
 
     def start_before(self, **kwargs):
         # 初始化启动其他设备
@@ -584,3 +1063,54 @@ class Emby(Media):
         # 启动自己, 并开始监听流程
         self._connect()
         pass
+
+    def stop(self):
+        """
+        停止: 断开ws不再重连, 关闭后台线程和数据库, 避免重新加载后新旧实例重复选片和发送, 也不泄漏线程
+        :return:
+        """
+        self._ws_stop.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception as e:
+                logger.error(f"关闭 WebSocket 时发生错误：{e}")
+        if self._ws_thread is not None:
+            self._ws_thread.join(5)
+        self._notifier.close()
+        # 进度上报写入发件箱, 先于发件箱关闭
+        if self._progress_reporter is not None:
+            self._progress_reporter.close()
+        self._outbox.close()
+        if self._library_index is not None:
+            self._library_index.close()
+        self._hub.leave()
+
+    def _get_reconnect_stats(self):
+        with self._reconnect_lock:
+            stats = dict(self._reconnect_stats)
+            if self._disconnected_at is not None:
+                stats["current_downtime_s"] = time.monotonic() - self._disconnected_at
+        return stats
+
+    def metrics(self):
+        """
+        运行指标
+        :return:
+        """
+        return {
+            "http": self._http.stats(),
+            "user_data": self._user_data_tracker.stats(),
+            "item_cache": self._item_cache.stats(),
+            "prefetch": dict(self._prefetch_stats),
+            "session_table": self._session_table.stats(),
+            "repeat_filter": self._repeat_filter.stats(),
+            "notifications": self._notifier.stats(),
+            "websocket": self._frame_dispatcher.stats(),
+            "hub": self._hub.stats(),
+            "progress": self._progress_reporter.stats() if self._progress_reporter is not None else None,
+            "outbox": self._outbox.stats(),
+            "library_index": self._library_index.stats() if self._library_index is not None else None,
+            "reconnect": self._get_reconnect_stats(),
+        }
@@ -0,0 +1,320 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class ItemCache(object):
+    """
+    影片信息缓存, 按ItemId做LRU淘汰, 并带有过期时间
+    """
+    # 播放只需要这些字段(Plan为预取时计算好的播放计划)
+    FIELDS = ("Id", "Name", "Type", "Path", "Container", "IsFolder", "Plan")
+
+    def __init__(self, max_size: int = 256, ttl: float = 3600):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, item_id):
+        """
+        获取缓存的影片信息, 过期或不存在返回None
+        :param item_id:
+        :return:
+        """
+        with self._lock:
+            entry = self._items.get(item_id)
+            if entry is None or time.monotonic() - entry[0] > self._ttl:
+                if entry is not None:
+                    del self._items[item_id]
+                self._misses += 1
+                return None
+            self._items.move_to_end(item_id)
+            self._hits += 1
+            return dict(entry[1])
+
+    def put(self, item: dict):
+        """
+        缓存影片信息
+        :param item:
+        :return:
+        """
+        if self._max_size <= 0 or "Id" not in item:
+            return
+        value = {key: item[key] for key in self.FIELDS if key in item}
+        with self._lock:
+            self._items[item["Id"]] = (time.monotonic(), value)
+            self._items.move_to_end(item["Id"])
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, item_ids):
+        """
+        使指定影片缓存失效
+        :param item_ids:
+        :return:
+        """
+        with self._lock:
+            for item_id in item_ids:
+                self._items.pop(item_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._items), "hits": self._hits, "misses": self._misses}
+
+
+class SessionTable(object):
+    """
+    emby会话表, 由websocket推送的Sessions消息维护, 按DeviceName索引
+    """
+    def __init__(self, max_age: float = 10):
+        self._max_age = max_age
+        self._devices = {}
+        self._updated_at = None
+        self._lock = threading.Lock()
+        self._pushes = 0
+        self._resyncs = 0
+
+    def replace(self, sessions, pushed=True):
+        """
+        用完整的会话列表替换索引
+        :param sessions:
+        :param pushed: True为websocket推送, False为REST重新同步
+        :return:
+        """
+        devices = {}
+        for session in sessions:
+            devices.setdefault(session.get("DeviceName"), []).append(session)
+        with self._lock:
+            self._devices = devices
+            self._updated_at = time.monotonic()
+            if pushed:
+                self._pushes += 1
+            else:
+                self._resyncs += 1
+
+    def get(self, device_name):
+        """
+        按设备名获取会话列表
+        :param device_name:
+        :return:
+        """
+        with self._lock:
+            return list(self._devices.get(device_name, []))
+
+    def is_stale(self):
+        with self._lock:
+            return self._updated_at is None or time.monotonic() - self._updated_at > self._max_age
+
+    def invalidate(self):
+        with self._lock:
+            self._updated_at = None
+
+    def stats(self):
+        with self._lock:
+            age = None if self._updated_at is None else round(time.monotonic() - self._updated_at, 1)
+            return {"devices": len(self._devices), "age_s": age, "pushes": self._pushes, "resyncs": self._resyncs}
+
+
+class RepeatFilter(object):
+    """
+    重复播放过滤, 按播放时间顺序保存影片, 过期项从队头淘汰(均摊O(1)), 可选持久化到文件
+    """
+    def __init__(self, timeout: float = 120, max_size: int = 1024, path: str = None):
+        self._timeout = timeout
+        self._max_size = max_size
+        self._path = path
+        # item_id -> 播放时间(使用墙上时间, 重启后依然有效)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _expire(self, now):
+        while len(self._entries) > 0:
+            item_id, played_time = next(iter(self._entries.items()))
+            if now - played_time <= self._timeout:
+                break
+            self._entries.popitem(last=False)
+
+    def contains(self, item_id):
+        """
+        影片是否在过滤时间内播放过
+        :param item_id:
+        :return:
+        """
+        with self._lock:
+            self._expire(time.time())
+            return item_id in self._entries
+
+    def add(self, item_id):
+        """
+        记录影片播放时间
+        :param item_id:
+        :return:
+        """
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            self._entries[item_id] = now
+            self._entries.move_to_end(item_id)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def _load(self):
+        if self._path is None or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, 'r', encoding='utf-8') as file:
+                entries = json.load(file)
+            for item_id, played_time in sorted(entries.items(), key=lambda entry: entry[1]):
+                self._entries[item_id] = played_time
+            self._expire(time.time())
+        except Exception as e:
+            logger.error(f"load repeat filter error: {e}")
+
+    def _save(self):
+        if self._path is None:
+            return
+        try:
+            temp_path = self._path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(self._entries, file)
+            os.replace(temp_path, self._path)
+        except Exception as e:
+            logger.error(f"save repeat filter error: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "persistent": self._path is not None}
+
+
+class UserDataTracker(object):
+    """
+    记录每部影片最近一次的用户数据, 只有与播放意图相关的变化才视为选片
+    """
+    FIELDS = ("Played", "IsFavorite", "LastPlayedDate", "PlaybackPositionTicks")
+    # 没有记录的影片, 最后播放时间在多少秒内才视为刚刚选片(容忍服务器与本机的时钟误差)
+    FIRST_SEEN_WINDOW = 120
+
+    def __init__(self, triggers=("Played", "PlayButton", "IsFavorite"), max_size: int = 1024):
+        """
+        :param triggers: 视为选片的变化: Played(切换已播放), IsFavorite(切换收藏), PlayButton(点击播放按钮)
+        :param max_size:
+        """
+        self._triggers = set(triggers)
+        self._max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._accepted = 0
+        self._dropped = 0
+
+    def is_play_intent(self, user_data: dict):
+        """
+        与上一次的用户数据比较, 判断是否为选片
+        启动后第一次见到的影片没有记录可以比较, 只接受刚刚刷新了最后播放时间的变化(见 _first_seen_intent),
+        其他客户端保存进度、评分等不会触发; 收藏切换只能在有记录后识别
+        :param user_data:
+        :return:
+        """
+        item_id = user_data["ItemId"]
+        snapshot = {key: user_data.get(key) for key in self.FIELDS}
+        with self._lock:
+            previous = self._items.get(item_id)
+            self._items[item_id] = snapshot
+            self._items.move_to_end(item_id)
+            while len(self._items) > self._max_size:
+                self._items.popitem(last=False)
+            if previous is None:
+                intent = self._first_seen_intent(snapshot, time.time() - self.FIRST_SEEN_WINDOW)
+            else:
+                intent = self._changed(previous, snapshot)
+            if intent:
+                self._accepted += 1
+            else:
+                self._dropped += 1
+            return intent
+
+    def is_missed_play_intent(self, user_data: dict, since: float):
+        """
+        断线补偿时判断错过的变化是否为选片, 只读取记录不更新(补发的消息还会经过 is_play_intent)
+        没有记录时无法比较切换, 只接受断线期间刷新了最后播放时间且没有播放进度的影片
+        :param user_data:
+        :param since: 断线前最后收到消息的时间(time.time())
+        :return:
+        """
+        current = {key: user_data.get(key) for key in self.FIELDS}
+        with self._lock:
+            previous = self._items.get(user_data["ItemId"])
+        if previous is not None:
+            if "Played" in self._triggers and previous["Played"] != current["Played"]:
+                return True
+            if "IsFavorite" in self._triggers and previous["IsFavorite"] != current["IsFavorite"]:
+                return True
+        if previous is None:
+            return self._first_seen_intent(current, since - 5)
+        last_played = self._parse_date(current["LastPlayedDate"])
+        if last_played is None or last_played < since - 5:
+            return False
+        return ("PlayButton" in self._triggers
+                and (current["PlaybackPositionTicks"] or 0) <= (previous["PlaybackPositionTicks"] or 0))
+
+    def _first_seen_intent(self, current, since: float):
+        """
+        没有记录的影片: since之后刷新了最后播放时间, 并且已标记为已播放或者没有播放进度才视为选片
+        :param current:
+        :param since: time.time() 时间
+        :return:
+        """
+        last_played = self._parse_date(current["LastPlayedDate"])
+        if last_played is None or last_played < since:
+            return False
+        return ("Played" in self._triggers and current["Played"] is True
+                or "PlayButton" in self._triggers and not current["PlaybackPositionTicks"])
+
+    @staticmethod
+    def _parse_date(value):
+        """
+        解析emby的UTC时间(例如 2025-01-01T12:00:00.0000000Z), 返回时间戳
+        :param value:
+        :return:
+        """
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            return None
+
+    def _changed(self, previous, current):
+        if "Played" in self._triggers and previous["Played"] != current["Played"]:
+            return True
+        if "IsFavorite" in self._triggers and previous["IsFavorite"] != current["IsFavorite"]:
+            return True
+        # 开始播放时会刷新最后播放时间, 但播放位置不会前进(其他客户端停止播放时保存进度会让位置变化)
+        if ("PlayButton" in self._triggers and current["LastPlayedDate"]
+                and current["LastPlayedDate"] != previous["LastPlayedDate"]
+                and (current["PlaybackPositionTicks"] or 0) <= (previous["PlaybackPositionTicks"] or 0)):
+            return True
+        return False
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._items), "accepted": self._accepted, "dropped": self._dropped}
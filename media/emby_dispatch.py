@@ -0,0 +1,252 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+"""
+
+import json
+import logging
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationDispatcher(object):
+    """
+    异步消息分发, 同一会话在合并窗口内的消息合并为一条发送, 队列满时丢弃最旧的消息
+    """
+    # 合并时保留级别最高的标题
+    HEADER_LEVELS = {"Error": 3, "Warning": 2, "Notification": 1}
+
+    def __init__(self, send: Callable[[str, str, str], None], merge_window: float = 0.5,
+                 max_pending: int = 32, max_merged: int = 5):
+        self._send = send
+        self._merge_window = merge_window
+        self._max_pending = max_pending
+        self._max_merged = max_merged
+        # session_id -> [发送时间, header, [message]]
+        self._pending = OrderedDict()
+        self._cond = threading.Condition()
+        self._sent = 0
+        self._merged = 0
+        self._dropped = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="emby-notify")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def dispatch(self, session_id, header, message):
+        """
+        投递消息, 立即返回
+        :param session_id:
+        :param header:
+        :param message:
+        :return:
+        """
+        with self._cond:
+            if self._closed:
+                return
+            entry = self._pending.get(session_id)
+            if entry is not None:
+                self._merged += 1
+                if self.HEADER_LEVELS.get(header, 0) > self.HEADER_LEVELS.get(entry[1], 0):
+                    entry[1] = header
+                if message not in entry[2]:
+                    entry[2].append(message)
+                    if len(entry[2]) > self._max_merged:
+                        entry[2].pop(0)
+                return
+            if len(self._pending) >= self._max_pending:
+                self._pending.popitem(last=False)
+                self._dropped += 1
+            self._pending[session_id] = [time.monotonic() + self._merge_window, header, [message]]
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._pending) <= 0 and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                session_id, entry = next(iter(self._pending.items()))
+                wait_time = entry[0] - time.monotonic()
+                if wait_time > 0:
+                    self._cond.wait(wait_time)
+                    continue
+                del self._pending[session_id]
+                self._sent += 1
+            try:
+                self._send(session_id, entry[1], "\n".join(entry[2]))
+            except Exception as e:
+                logger.error(f"Exception during dispatch message: {e}")
+
+    def close(self, timeout: float = 5):
+        """
+        停止后台线程, 未发送的消息丢弃
+        :param timeout: 等待后台线程结束的时间(秒)
+        :return:
+        """
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {"pending": len(self._pending), "sent": self._sent,
+                    "merged": self._merged, "dropped": self._dropped}
+
+
+class FrameDispatcher(object):
+    """
+    websocket消息分发: 接收线程只读取消息类型并入队, 不关心的类型直接丢弃,
+    由工作线程完整解析并处理, 同一分组(默认为消息类型)的消息总是由同一工作线程按顺序处理
+    """
+    # 只扫描 MessageType 字段, 不解析整个消息
+    MESSAGE_TYPE_PATTERN = re.compile(r'"MessageType"\s*:\s*"([^"]*)"')
+
+    def __init__(self, handle: Optional[Callable[[dict], None]], workers: int = 2, max_queue: int = 256,
+                 groups: dict = None, accept: set = None, quiet: set = None):
+        """
+        :param handle: 默认的消息处理函数(多个连接共用时由submit传入各自的处理函数)
+        :param workers: 工作线程数
+        :param max_queue: 每个工作线程的队列长度
+        :param groups: 消息类型 -> 分组, 同一分组按顺序处理, 声明的每个分组独占一个工作线程,
+                       其他消息类型共用剩余的工作线程
+        :param accept: 需要处理的消息类型, None表示全部处理
+        :param quiet: 只在debug级别记录日志的消息类型
+        """
+        self._handle = handle
+        self._groups = groups or {}
+        self._accept = accept
+        self._quiet = quiet or set()
+        # 声明的分组独占工作线程, 避免耗时的播放流程阻塞其他消息
+        declared_groups = sorted(set(self._groups.values()))
+        self._group_lanes = {group: index for index, group in enumerate(declared_groups)}
+        self._shared_lane_start = len(declared_groups)
+        self._lanes = [queue.Queue(maxsize=max_queue)
+                       for _ in range(max(workers, len(declared_groups) + 1))]
+        self._lock = threading.Lock()
+        self._received = 0
+        self._dropped = 0
+        self._handled = 0
+        self._errors = 0
+        self._skipped_frames = 0
+        self._skipped_bytes = 0
+        self._skipped_types = {}
+        self._last_lag_ms = 0.0
+        self._max_lag_ms = 0.0
+        self._closed = False
+        self._workers = []
+        for index, lane in enumerate(self._lanes):
+            worker = threading.Thread(target=self._work, args=(lane,), name=f"emby-ws-worker-{index}")
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    @classmethod
+    def classify(cls, frame):
+        """
+        快速读取消息类型(MessageType一般在消息开头)
+        :param frame:
+        :return:
+        """
+        match = cls.MESSAGE_TYPE_PATTERN.search(frame, 0, 256) or cls.MESSAGE_TYPE_PATTERN.search(frame)
+        return match.group(1) if match else None
+
+    def _lane_index(self, msg_type):
+        group = self._groups.get(msg_type)
+        if group is not None:
+            return self._group_lanes[group]
+        shared_lanes = len(self._lanes) - self._shared_lane_start
+        return self._shared_lane_start + hash(msg_type) % shared_lanes
+
+    def submit(self, frame, handle: Callable[[dict], None] = None):
+        """
+        接收线程调用, 只分类和入队, 不做解析和处理
+        :param frame:
+        :param handle: 本消息的处理函数, 默认使用构造时传入的
+        :return:
+        """
+        if self._closed:
+            return
+        msg_type = self.classify(frame)
+        if self._accept is not None and msg_type not in self._accept:
+            with self._lock:
+                self._skipped_frames += 1
+                self._skipped_bytes += len(frame)
+                self._skipped_types[msg_type] = self._skipped_types.get(msg_type, 0) + 1
+            return
+        lane = self._lanes[self._lane_index(msg_type)]
+        try:
+            lane.put_nowait((time.monotonic(), msg_type, frame, handle or self._handle))
+            with self._lock:
+                self._received += 1
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            logger.warning(f"Emby WebSocket queue is full, drop message: {msg_type}")
+
+    def _work(self, lane):
+        while not self._closed:
+            task = lane.get()
+            if task is None:
+                break
+            received_at, msg_type, frame, handle = task
+            lag_ms = (time.monotonic() - received_at) * 1000
+            with self._lock:
+                self._last_lag_ms = lag_ms
+                self._max_lag_ms = max(self._max_lag_ms, lag_ms)
+            try:
+                if msg_type in self._quiet:
+                    logger.debug(f"Emby WebSocket Message Received: {frame}")
+                else:
+                    logger.info(f"Emby WebSocket Message Received: {frame}")
+                handle(json.loads(frame))
+                with self._lock:
+                    self._handled += 1
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                logger.error(f"Exception during WebSocket message handling: {e}")
+
+    def close(self, timeout: float = 5):
+        """
+        停止工作线程, 队列中剩余的消息不再处理
+        :param timeout: 等待每个工作线程结束的时间(秒)
+        :return:
+        """
+        self._closed = True
+        for lane in self._lanes:
+            try:
+                lane.put_nowait(None)
+            except queue.Full:
+                # 队列已满时工作线程处理完当前消息后检查到关闭也会退出
+                pass
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": sum(lane.qsize() for lane in self._lanes),
+                "received": self._received,
+                "dropped": self._dropped,
+                "handled": self._handled,
+                "errors": self._errors,
+                "skipped_frames": self._skipped_frames,
+                "skipped_bytes": self._skipped_bytes,
+                "skipped_types": dict(self._skipped_types),
+                "last_lag_ms": round(self._last_lag_ms, 1),
+                "max_lag_ms": round(self._max_lag_ms, 1),
+            }
@@ -0,0 +1,122 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+"""
+
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class EmbyHttpClient(object):
+    """
+    emby http客户端, 每个服务器一个长连接池, 预置认证头, 并记录每个接口的耗时
+    """
+    def __init__(self, host: str, pool_size: int = 4, connect_timeout: float = 3, read_timeout: float = 10,
+                 on_unauthorized=None):
+        """
+        :param host:
+        :param pool_size:
+        :param connect_timeout:
+        :param read_timeout:
+        :param on_unauthorized: 服务器返回401时调用, 返回True表示已重新登录, 请求会重试一次
+        """
+        self._host = host.rstrip('/')
+        self._on_unauthorized = on_unauthorized
+        self._timeout = (connect_timeout, read_timeout)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def set_headers(self, headers: dict):
+        """
+        替换预置的请求头(整体替换引用, 避免与正在进行的请求竞争)
+        在requests默认请求头的基础上更新, 保留 Accept-Encoding 等(响应压缩)
+        :param headers:
+        :return:
+        """
+        session_headers = requests.utils.default_headers()
+        session_headers.update(headers)
+        self._session.headers = session_headers
+
+    def request(self, method: str, path: str, endpoint: str = None, timeout=None, retry_unauthorized=True, **kwargs):
+        """
+        发送请求
+        :param method: GET/POST/DELETE
+        :param path: 以/开头的相对路径, 例如 /emby/Items
+        :param endpoint: 统计用的接口名, 默认为path(带id的路径请传入模板, 避免统计项无限增长)
+        :param timeout: 覆盖默认的(连接, 读取)超时
+        :param retry_unauthorized: 返回401时是否重新登录并重试
+        :param kwargs: 透传给requests
+        :return:
+        """
+        res = self._request(method, path, endpoint, timeout, **kwargs)
+        if (res.status_code == 401 and retry_unauthorized and self._on_unauthorized is not None
+                and self._on_unauthorized()):
+            res = self._request(method, path, endpoint, timeout, **kwargs)
+        return res
+
+    def _request(self, method, path, endpoint, timeout, **kwargs):
+        key = "{} {}".format(method, endpoint or path)
+        start_time = time.monotonic()
+        ok = False
+        try:
+            res = self._session.request(method, self._host + path, timeout=timeout or self._timeout, **kwargs)
+            ok = res.status_code < 400
+            return res
+        finally:
+            self._record(key, (time.monotonic() - start_time) * 1000, ok)
+
+    def get(self, path: str, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path: str, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def _record(self, key, elapsed_ms, ok):
+        with self._lock:
+            stat = self._stats.get(key)
+            if stat is None:
+                stat = {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0}
+                self._stats[key] = stat
+            stat["count"] += 1
+            if not ok:
+                stat["errors"] += 1
+            stat["total_ms"] += elapsed_ms
+            stat["max_ms"] = max(stat["max_ms"], elapsed_ms)
+            stat["last_ms"] = elapsed_ms
+        logger.debug(f"emby request {key} took {elapsed_ms:.1f}ms")
+
+    def stats(self):
+        """
+        各接口耗时统计
+        :return:
+        """
+        with self._lock:
+            return {
+                key: {
+                    "count": stat["count"],
+                    "errors": stat["errors"],
+                    "avg_ms": round(stat["total_ms"] / stat["count"], 1),
+                    "max_ms": round(stat["max_ms"], 1),
+                    "last_ms": round(stat["last_ms"], 1),
+                }
+                for key, stat in self._stats.items()
+            }
+
+    def close(self):
+        self._session.close()
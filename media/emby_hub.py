@@ -0,0 +1,90 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from media.emby_cache import ItemCache
+from media.emby_dispatch import FrameDispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class EmbyHub(object):
+    """
+    多个emby实例(多服务器/多用户)共享的资源: 有界的消息处理线程和阻止命令线程池, 按服务器共享的影片缓存;
+    所有实例的选片消息都进入同一个播放分组按顺序处理, 同一时间只有一个实例在驱动播放器
+    """
+    def __init__(self, configs: list):
+        """
+        :param configs: 共享本实例的所有emby配置, 线程数和队列长度取其中的最大值
+        """
+        configs = [config for config in configs if config] or [{}]
+        # 会触发播放的消息放在同一分组, 保证按顺序处理; 阻止设备播放的消息单独一个分组,
+        # 不会排在媒体库变化(需要请求服务器)后面; 每个分组独占一个工作线程, 其他消息共用剩余的
+        self.frame_dispatcher = FrameDispatcher(
+            None,
+            workers=max(config.get("WsWorkers", 3) for config in configs),
+            max_queue=max(config.get("WsQueueSize", 256) for config in configs),
+            groups={"Play": "play", "Playstate": "play", "UserDataChanged": "play",
+                    "Sessions": "block", "PlaybackStart": "block"},
+            accept={"Play", "Playstate", "UserDataChanged", "LibraryChanged", "Sessions", "PlaybackStart"},
+            quiet={"LibraryChanged", "Sessions"})
+        self.stop_executor = ThreadPoolExecutor(max_workers=max(config.get("StopWorkers", 4) for config in configs),
+                                                thread_name_prefix="emby-stop")
+        self._item_caches = {}
+        self._lock = threading.Lock()
+        self._members = 0
+        logger.debug(f"emby hub created for {len(configs)} instance(s)")
+
+    def join(self):
+        """
+        登记一个使用本实例的emby
+        :return:
+        """
+        with self._lock:
+            self._members += 1
+
+    def leave(self):
+        """
+        注销一个使用本实例的emby, 最后一个停止后关闭消息处理线程和阻止命令线程池
+        :return:
+        """
+        with self._lock:
+            self._members -= 1
+            if self._members > 0:
+                return
+        logger.debug("emby hub closed, no instance left")
+        self.frame_dispatcher.close()
+        self.stop_executor.shutdown(wait=False)
+
+    def item_cache(self, host: str, max_size: int = 256, ttl: float = 3600):
+        """
+        获取服务器的影片缓存, 同一服务器的多个用户共用一份(影片id只在服务器内唯一)
+        :param host:
+        :param max_size: 首次创建时使用
+        :param ttl: 首次创建时使用
+        :return:
+        """
+        key = host.rstrip('/')
+        with self._lock:
+            cache = self._item_caches.get(key)
+            if cache is None:
+                cache = ItemCache(max_size=max_size, ttl=ttl)
+                self._item_caches[key] = cache
+            return cache
+
+    def stats(self):
+        with self._lock:
+            item_caches = dict(self._item_caches)
+            members = self._members
+        return {
+            "members": members,
+            "item_caches": {host: cache.stats() for host, cache in item_caches.items()},
+        }
@@ -0,0 +1,144 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryIndex(object):
+    """
+    本地媒体库索引: ItemId -> Path/Container/IsFolder, 以及预先计算好的播放计划
+    """
+    def __init__(self, path: str, resolve_plan: Callable[[dict], Optional[dict]], plan_version: Callable[[], str]):
+        """
+        :param path: sqlite文件路径
+        :param resolve_plan: 根据影片信息计算播放计划
+        :param plan_version: 当前播放计划的版本, 与保存的版本不一致时计划失效
+        """
+        self._resolve_plan = resolve_plan
+        self._plan_version = plan_version
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._synced_at = None
+        self._closed = False
+        self._db = self._open(path)
+
+    @staticmethod
+    def _open(path):
+        try:
+            db = sqlite3.connect(path, check_same_thread=False)
+        except Exception as e:
+            logger.error(f"open library index {path} error: {e}, fallback to memory")
+            db = sqlite3.connect(":memory:", check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS items ("
+                   "id TEXT PRIMARY KEY, path TEXT NOT NULL, container TEXT NOT NULL, is_folder INTEGER NOT NULL, "
+                   "plan TEXT, plan_version TEXT)")
+        db.commit()
+        return db
+
+    def get(self, item_id):
+        """
+        获取影片信息, 播放计划在 "Plan" 字段中(计划失效时为None)
+        :param item_id:
+        :return:
+        """
+        with self._lock:
+            if self._closed:
+                return None
+            row = self._db.execute("SELECT id, path, container, is_folder, plan, plan_version FROM items "
+                                   "WHERE id = ?", (item_id,)).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        plan = json.loads(row[4]) if row[4] is not None and row[5] == self._plan_version() else None
+        return {"Id": row[0], "Path": row[1], "Container": row[2], "IsFolder": row[3] == 1, "Plan": plan}
+
+    def upsert(self, items):
+        """
+        写入或更新影片, 同时计算播放计划
+        :param items:
+        :return:
+        """
+        plan_version = self._plan_version()
+        rows = []
+        for item in items:
+            if "Id" not in item or not item.get("Path") or not item.get("Container"):
+                continue
+            plan = None
+            if item.get("IsFolder") is not True:
+                try:
+                    plan = self._resolve_plan(item)
+                except Exception as e:
+                    logger.debug(f"resolve play plan error, item: {item['Id']}, error: {e}")
+            rows.append((item["Id"], item["Path"], item["Container"], 1 if item.get("IsFolder") is True else 0,
+                         json.dumps(plan) if plan is not None else None, plan_version))
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO items (id, path, container, is_folder, plan, plan_version) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+        return len(rows)
+
+    def remove(self, item_ids):
+        with self._lock:
+            self._db.executemany("DELETE FROM items WHERE id = ?", [(item_id,) for item_id in item_ids])
+            self._db.commit()
+
+    def sync(self, fetch_page: Callable[[int, int], Optional[tuple]], page_size: int = 500):
+        """
+        全量同步, 分页拉取整个媒体库, 同步完成后删除服务器上已不存在的影片
+        :param fetch_page: (start_index, limit) -> (items, total_count), 失败返回None
+        :param page_size:
+        :return:
+        """
+        start_time = time.time()
+        seen_ids = set()
+        start_index = 0
+        while True:
+            page = fetch_page(start_index, page_size)
+            if page is None:
+                logger.error("library index sync failed, keep the old index")
+                return False
+            items, total_count = page
+            self.upsert(items)
+            seen_ids.update(item["Id"] for item in items if "Id" in item)
+            start_index += len(items)
+            if len(items) <= 0 or start_index >= total_count:
+                break
+        with self._lock:
+            stale_ids = [row[0] for row in self._db.execute("SELECT id FROM items") if row[0] not in seen_ids]
+        self.remove(stale_ids)
+        with self._lock:
+            self._synced_at = time.time()
+        logger.info(f"library index synced, items: {len(seen_ids)}, removed: {len(stale_ids)}, "
+                    f"cost: {time.time() - start_time:.1f}s")
+        return True
+
+    def close(self):
+        """
+        关闭数据库, 之后的查询都视为未命中
+        :return:
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._db.close()
+
+    def stats(self):
+        with self._lock:
+            size = None if self._closed else self._db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+            return {"size": size, "hits": self._hits, "misses": self._misses, "synced_at": self._synced_at}
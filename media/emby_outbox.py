@@ -0,0 +1,168 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(object):
+    """
+    持久化发件箱: 需要写入媒体库的操作先保存到本地sqlite, 由后台线程批量发送, 失败后按指数退避重试
+    """
+    def __init__(self, path: str, handlers: Dict[str, Callable[..., bool]], batch_size: int = 10,
+                 max_attempts: int = 20, base_delay: float = 5, max_delay: float = 600):
+        """
+        :param path: sqlite文件路径
+        :param handlers: 操作类型 -> 发送函数, 发送函数返回True表示成功
+        :param batch_size: 每批发送数量
+        :param max_attempts: 最大尝试次数, 超过后丢弃
+        :param base_delay: 首次重试等待时间(秒)
+        :param max_delay: 最大重试等待时间(秒)
+        """
+        self._handlers = handlers
+        self._batch_size = batch_size
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._closed = False
+        self._sent = 0
+        self._failed = 0
+        self._discarded = 0
+        self._db = self._open(path)
+        self._thread = threading.Thread(target=self._run, name="emby-outbox")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _open(path):
+        try:
+            db = sqlite3.connect(path, check_same_thread=False)
+        except Exception as e:
+            logger.error(f"open outbox {path} error: {e}, fallback to memory")
+            db = sqlite3.connect(":memory:", check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS outbox ("
+                   "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, args TEXT NOT NULL, "
+                   "coalesce_key TEXT, attempts INTEGER NOT NULL DEFAULT 0, next_at REAL NOT NULL)")
+        db.execute("CREATE INDEX IF NOT EXISTS outbox_next_at ON outbox (next_at)")
+        db.commit()
+        return db
+
+    def put(self, kind: str, *args, coalesce_key: str = None):
+        """
+        加入发件箱, 立即返回; 相同coalesce_key的待发送操作会被替换为最新的一条
+        关闭后(重新加载配置后旧实例仍在结束播放)丢弃并记录日志
+        :param kind:
+        :param args:
+        :param coalesce_key:
+        :return:
+        """
+        with self._lock:
+            if self._closed:
+                logger.warning(f"outbox closed, drop {kind} {args}")
+                return
+            if coalesce_key is not None:
+                self._db.execute("DELETE FROM outbox WHERE coalesce_key = ?", (coalesce_key,))
+            self._db.execute("INSERT INTO outbox (kind, args, coalesce_key, next_at) VALUES (?, ?, ?, ?)",
+                             (kind, json.dumps(args), coalesce_key, time.time()))
+            self._db.commit()
+        self._wakeup.set()
+
+    def _due_batch(self):
+        with self._lock:
+            rows = self._db.execute("SELECT id, kind, args, attempts FROM outbox WHERE next_at <= ? "
+                                    "ORDER BY id LIMIT ?", (time.time(), self._batch_size)).fetchall()
+            next_at = None
+            if len(rows) <= 0:
+                next_at = self._db.execute("SELECT MIN(next_at) FROM outbox").fetchone()[0]
+            return rows, next_at
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                rows, next_at = self._due_batch()
+                if len(rows) <= 0:
+                    wait_time = None if next_at is None else max(0.0, next_at - time.time())
+                    self._wakeup.wait(wait_time)
+                    self._wakeup.clear()
+                    continue
+                for row_id, kind, args, attempts in rows:
+                    if self._stop.is_set():
+                        break
+                    delay = self._send(row_id, kind, json.loads(args), attempts)
+                    if delay is not None:
+                        # 服务器大概率不可用, 整个发件箱按本次的退避时间等待, 避免剩余的操作连续失败
+                        self._stop.wait(delay)
+                        break
+            except Exception as e:
+                logger.error(f"Exception during outbox run: {e}")
+                self._stop.wait(self._base_delay)
+
+    def _send(self, row_id, kind, args, attempts):
+        """
+        发送一条操作
+        :return: 发送失败需要重试时返回退避时间(秒), 否则返回None
+        """
+        ok = False
+        delay = None
+        try:
+            handler = self._handlers.get(kind)
+            if handler is None:
+                logger.error(f"outbox has no handler for {kind}, discard")
+                ok = True
+            else:
+                ok = handler(*args) is True
+        except Exception as e:
+            logger.error(f"Exception during outbox send {kind}: {e}")
+        with self._lock:
+            if self._closed:
+                return None
+            if ok:
+                self._db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+                self._sent += 1
+            elif attempts + 1 >= self._max_attempts:
+                self._db.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+                self._discarded += 1
+                logger.error(f"outbox {kind} {args} failed {attempts + 1} times, discard")
+            else:
+                delay = min(self._max_delay, self._base_delay * (2 ** attempts))
+                self._db.execute("UPDATE outbox SET attempts = ?, next_at = ? WHERE id = ?",
+                                 (attempts + 1, time.time() + delay, row_id))
+                self._failed += 1
+                logger.warning(f"outbox {kind} failed, retry in {delay}s")
+            self._db.commit()
+        return delay
+
+    def close(self, timeout: float = 5):
+        """
+        停止后台线程并关闭数据库, 未发送的操作留在数据库中, 下次启动后继续发送
+        :param timeout: 等待后台线程结束的时间(秒)
+        :return:
+        """
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._db.close()
+
+    def stats(self):
+        with self._lock:
+            pending = None if self._closed else self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            return {"pending": pending, "sent": self._sent, "failed": self._failed, "discarded": self._discarded}
@@ -0,0 +1,161 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# emby的进度单位, 播放器上报前已换算(见 PlaybackSession.REPORT_TICKS_PER_SECOND)
+TICKS_PER_SECOND = 10000000
+
+
+class ProgressReporter(object):
+    """
+    播放进度同步: 合并播放器的进度更新, 在两次采样之间推算当前位置, 由后台线程按固定间隔上报
+    开始事件在收到第一次进度(播放器确认已开始播放)时才上报, 播放失败时不会留下没有结束的播放记录
+    """
+    def __init__(self, report_start: Callable[[str], None], report_progress: Callable[[str, int, int], None],
+                 report_stopped: Callable[[str, int], None], interval: float = 30, max_extrapolation: float = 90):
+        """
+        :param report_start: (item_id)
+        :param report_progress: (item_id, position_ticks, total_ticks)
+        :param report_stopped: (item_id, position_ticks)
+        :param interval: 上报间隔(秒)
+        :param max_extrapolation: 距离上次采样最多推算多少秒, 避免暂停时位置跑偏
+        """
+        self._report_start = report_start
+        self._report_progress = report_progress
+        self._report_stopped = report_stopped
+        self._interval = interval
+        self._max_extrapolation = max_extrapolation
+        self._playing = None
+        self._events = []
+        self._cond = threading.Condition()
+        self._reports = 0
+        self._updates = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="emby-progress")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def begin(self, item_id):
+        """
+        准备播放(此时播放器可能还没有开始播放, 开始事件等到第一次进度时再上报)
+        :param item_id:
+        :return:
+        """
+        with self._cond:
+            self._playing = {"item_id": item_id, "position": 0, "total": 0, "sampled_at": None,
+                             "reported_at": time.monotonic(), "started": False}
+
+    def update(self, position_ticks, total_ticks):
+        """
+        播放器采样到的进度, 只保留最新的一次
+        :param position_ticks:
+        :param total_ticks:
+        :return:
+        """
+        with self._cond:
+            if self._playing is None:
+                return
+            if not self._playing["started"]:
+                self._playing["started"] = True
+                self._playing["reported_at"] = time.monotonic()
+                self._events.append(("start", self._playing["item_id"], 0, 0))
+                self._cond.notify()
+            self._playing["position"] = position_ticks
+            self._playing["total"] = total_ticks
+            self._playing["sampled_at"] = time.monotonic()
+            self._updates += 1
+
+    def end(self, position_ticks, total_ticks):
+        """
+        播放结束, 上报播放器给出的最终位置(播放器已经推算过, 不再累加推算时间)
+        :param position_ticks:
+        :param total_ticks:
+        :return:
+        """
+        with self._cond:
+            if self._playing is None:
+                return
+            if self._playing["started"]:
+                position = max(position_ticks, self._playing["position"])
+                total = max(total_ticks, self._playing["total"])
+                if total > 0:
+                    position = min(position, total)
+                self._events.append(("stopped", self._playing["item_id"], position, 0))
+                self._cond.notify()
+            self._playing = None
+
+    def _estimate(self, playing):
+        position = playing["position"]
+        if playing["sampled_at"] is not None:
+            elapsed = min(time.monotonic() - playing["sampled_at"], self._max_extrapolation)
+            position += int(elapsed * TICKS_PER_SECOND)
+        if playing["total"] > 0:
+            position = min(position, playing["total"])
+        return position
+
+    def _next_event(self):
+        with self._cond:
+            while True:
+                if len(self._events) > 0:
+                    return self._events.pop(0)
+                # 关闭前先把已产生的事件(例如结束)交给发件箱
+                if self._closed:
+                    return None
+                if self._playing is None:
+                    self._cond.wait()
+                    continue
+                wait_time = self._playing["reported_at"] + self._interval - time.monotonic()
+                if wait_time > 0:
+                    self._cond.wait(wait_time)
+                    continue
+                self._playing["reported_at"] = time.monotonic()
+                # 还没有开始播放时不上报
+                if not self._playing["started"]:
+                    continue
+                return "progress", self._playing["item_id"], self._estimate(self._playing), self._playing["total"]
+
+    def _run(self):
+        while True:
+            next_event = self._next_event()
+            if next_event is None:
+                return
+            event, item_id, position_ticks, total_ticks = next_event
+            try:
+                if event == "start":
+                    self._report_start(item_id)
+                elif event == "progress":
+                    self._report_progress(item_id, position_ticks, total_ticks)
+                else:
+                    self._report_stopped(item_id, position_ticks)
+                with self._cond:
+                    self._reports += 1
+            except Exception as e:
+                logger.error(f"Exception during report play progress: {e}")
+
+    def close(self, timeout: float = 5):
+        """
+        停止后台线程, 已产生的开始/结束事件上报后退出
+        :param timeout: 等待后台线程结束的时间(秒)
+        :return:
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            return {"playing": self._playing is not None and self._playing["started"],
+                    "updates": self._updates, "reports": self._reports}
@@ -7,6 +7,9 @@ the Free Software Foundation, either version 3 of the License, or
 any later version
 """
 
+import hashlib
+import os
+import select
 import socket
 import time
 import logging
@@ -15,12 +18,19 @@ import json
 import threading
 import urllib.parse
 from abstract_classes import Player, PlayerException
+from player.oppo_list import parse_list
+from player.playback import PlaybackSession
 
 
 logger = logging.getLogger(__name__)
 
 
 class Oppo(Player):
+    # UDP登录消息的重发间隔(秒), 之后按最后一个间隔重发直到超时
+    HANDSHAKE_RESEND_DELAYS = (0.2, 0.3, 0.5, 1, 2)
+    # 握手失败(播放机离线)后的重试间隔上限(秒)
+    HANDSHAKE_MAX_RETRY_DELAY = 60
+
     def __init__(self, config: dict):
         super().__init__(config)
         try:
@@ -36,47 +46,66 @@ class Oppo(Player):
             self._play_start_timeout = self._config.get('PlayStartTimeout', 5)
             self._play_end_timeout = self._config.get('PlayEndTimeout', 5)
             self._device_list = []
-            self._on_message = None
-            self._on_play_begin = None
-            self._on_play_in_progress = None
-            self._on_play_end = None
-            self._position_ticks = 0
-            self._total_ticks = 0
-            self._play_status = -1
+            # 播放会话由共用的监控线程跟踪
+            self._playback = PlaybackSession("oppo", self._query_play_status, 10000000,
+                                             fast_interval=self._config.get('PollInterval', 1),
+                                             slow_interval=self._config.get('PollSlowInterval', 10),
+                                             failure_timeout=5,
+                                             sample_progress=self._get_playing_time,
+                                             on_lost=lambda: self._request_handshake("lost player during playback"),
+                                             on_finished=self._mount_prepared)
+            self._mount_lock = threading.Lock()
+            self._prepared_plan = None
+            # 当前已挂载的 (协议, 服务器, 目录), 播放机断电重启或共享目录消失时失效
+            self._mounted = None
+            # 每个smb共享目录上次挂载成功的用户名(只保存用户名, 密码仍从Auth中读取)
+            self._smb_auth_path = os.path.join(
+                os.getenv("CONFIG_DIR", "config"),
+                "oppo_smb_auth_{}.json".format(hashlib.md5(str(self._ip).encode("utf-8")).hexdigest()[:8]))
+            self._smb_auth_map = self._load_smb_auth()
+            # 握手状态: idle -> handshaking -> ready / offline, 只在调用失败或播放机重新上线时重新握手
+            self._ready = threading.Event()
+            self._handshake_wakeup = threading.Event()
         except Exception as e:
             raise PlayerException(e)
 
     def _open_oppo_http(self):
         """
-        开启OPPO HTTP协议
+        开启OPPO HTTP协议, 按重发间隔发送UDP登录消息, 用select等待响应
         :return:
         """
         open_http_success = False
-        udp_msg = "NOTIFY OREMOTE LOGIN"
+        udp_msg = bytes("NOTIFY OREMOTE LOGIN", "utf-8")
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setblocking(False)  # 设置非阻塞模式
-        start_time = time.time()
-        while True:
-            # 发送消息
-            sock.sendto(bytes(udp_msg, "utf-8"), self._udp_server_address)
-            # 尝试接收响应
-            try:
-                data, server = sock.recvfrom(1024)
-                msg = data.decode("utf-8")
-                if "REPORT ADDRESS TO OREMOTE" in msg:
-                    open_http_success = True
-                    logger.debug("open the oppo http success")
+        try:
+            deadline = time.monotonic() + self._udp_timeout
+            attempt = 0
+            while not open_http_success:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error(f"open the oppo http failed, timeout: {self._udp_timeout}s")
                     break
-            except BlockingIOError:
-                # 如果没有数据则继续发送
-                time.sleep(1)  # 等待 1 秒再重试
-            except Exception:
-                break
-            # 检查是否超时
-            if time.time() - start_time > self._udp_timeout:
-                logger.error(f"open the oppo http failed, timeout: {self._udp_timeout}s")
-                break
-        sock.close()
+                sock.sendto(udp_msg, self._udp_server_address)
+                resend_at = time.monotonic() + min(
+                    self.HANDSHAKE_RESEND_DELAYS[min(attempt, len(self.HANDSHAKE_RESEND_DELAYS) - 1)], remaining)
+                attempt += 1
+                # 在下次重发前持续接收, 忽略无关的报文
+                while True:
+                    wait_time = resend_at - time.monotonic()
+                    if wait_time <= 0:
+                        break
+                    readable, _, _ = select.select([sock], [], [], wait_time)
+                    if not readable:
+                        break
+                    data, server = sock.recvfrom(1024)
+                    if "REPORT ADDRESS TO OREMOTE" in data.decode("utf-8", errors="ignore"):
+                        open_http_success = True
+                        logger.debug(f"open the oppo http success, attempts: {attempt}")
+                        break
+        except Exception as e:
+            logger.error(f"open the oppo http exception, error: {e}")
+        finally:
+            sock.close()
         return open_http_success
 
     @staticmethod
@@ -193,27 +222,7 @@ class Oppo(Player):
         try:
             url = self._http_host + "/getSambaShareFolderlist"
             res = requests.get(url, timeout=5)
-            b = res.content.rsplit(b'\x01')
-            files = []
-            num = 1
-            for c in b:
-                if c.find(b'\x02') == -1:
-                    index = 0
-                    ult = 0
-                    d = c
-                    while index != -1:
-                        index = c.find(b'\x00', index)
-                        if index == -1:
-                            d = d[ult:]
-                        else:
-                            ult = index + 1
-                            index = index + 1
-                    e = d.decode('utf-8')
-                    if e != '':
-                        file = {"id": num, "folder": e}
-                        num = num + 1
-                        files.append(file)
-            return files
+            return parse_list(res.content)
         except Exception as e:
             logger.error(f"get samba share folder failed, error: {e}")
         return None
@@ -226,28 +235,7 @@ class Oppo(Player):
         try:
             url = self._http_host + "/getNfsShareFolderlist"
             res = requests.get(url, timeout=5)
-            print(res.text)
-            b = res.content.rsplit(b'\x01')
-            files = []
-            num = 1
-            for c in b:
-                if c.find(b'\x02') == -1:
-                    index = 0
-                    ult = 0
-                    d = c
-                    while index != -1:
-                        index = c.find(b'\x00', index)
-                        if index == -1:
-                            d = d[ult:]
-                        else:
-                            ult = index + 1
-                            index = index + 1
-                    e = d.decode('utf-8')
-                    if e != '':
-                        file = {"id": num, "folder": e}
-                        num = num + 1
-                        files.append(file)
-            return files
+            return parse_list(res.content)
         except Exception as e:
             logger.error(f"get nfs share folder failed, error: {e}")
         return None
@@ -266,28 +254,7 @@ class Oppo(Player):
             }
             url = self._http_host + "/getfilelist?" + self.dict_to_url_encoded_json(params)
             res = requests.get(url, timeout=5)
-            print(res.text)
-            b = res.content.rsplit(b'\x01')
-            files = []
-            num = 1
-            for c in b:
-                if c.find(b'\x02') == -1:
-                    index = 0
-                    ult = 0
-                    d = c
-                    while index != -1:
-                        index = c.find(b'\x00', index)
-                        if index == -1:
-                            d = d[ult:]
-                        else:
-                            ult = index + 1
-                            index = index + 1
-                    e = d.decode('utf-8')
-                    if e != '':
-                        file = {"id": num, "folder": e}
-                        num = num + 1
-                        files.append(file)
-            return files
+            return parse_list(res.content)
         except Exception as e:
             logger.error(f"get share folder failed, error: {e}")
         return None
@@ -411,7 +378,7 @@ class Oppo(Player):
     def _get_playing_time(self):
         """
         获取播放时间
-        :return:
+        :return: (position_ticks, total_ticks)
         """
         try:
             url = self._http_host + "/getplayingtime"
@@ -419,11 +386,7 @@ class Oppo(Player):
             if res.status_code == 200:
                 result = res.json()
                 if "success" in result and result["success"]:
-                    if result["cur_time"] > 0:
-                        self._position_ticks = result["cur_time"] * 10000000
-                    if result["total_time"] > 0:
-                        self._total_ticks = result["total_time"] * 10000000
-                    return True
+                    return result["cur_time"] * 10000000, result["total_time"] * 10000000
         except Exception as e:
             logger.error(f"get samba share folder failed, error: {e}")
         return None
@@ -458,59 +421,70 @@ class Oppo(Player):
             logger.error(f"check device online status failed, error: {e}")
             return False
 
-    def _track_play_status(self):
+    def _query_play_status(self):
         """
-        跟踪播放进度
+        查询是否正在播放
         :return:
         """
-        self._play_status = 0
-        last_qry_time = time.time()
-        last_report_time = 0
-        timeout = 5
-        while True:
-            time.sleep(1)
-            global_info = self._get_global_info()
-            if global_info is None:
-                if time.time() - last_qry_time > timeout:
-                    break
-                else:
-                    continue
-            if self._play_status == 0:
-                if global_info["is_video_playing"] is True:
-                    self._play_status = 1
-                    # 如果未在开始时切换HDMI，则在此处切换
-                    if not self._switch_hdmi_before_play:
-                        self._on_play_begin()
-            elif self._play_status == 1:
-                if global_info["is_video_playing"] is True:
-                    if time.time() - last_report_time > 60:
-                        self._get_playing_time()
-                        self._on_play_in_progress(position_ticks=self._position_ticks, total_ticks=self._total_ticks)
-                        last_report_time = time.time()
-                else:
-                    break
-            last_qry_time = time.time()
-        # 报告已结束
-        self._on_play_end(position_ticks=self._position_ticks, total_ticks=self._total_ticks)
-        self._position_ticks = 0
-        self._total_ticks = 0
-        self._play_status = -1
+        global_info = self._get_global_info()
+        if global_info is None:
+            return None
+        return {"playing": global_info["is_video_playing"] is True}
+
+    def _request_handshake(self, reason):
+        """
+        重新握手(播放机调用失败或需要确认播放机是否重新上线)
+        :param reason:
+        :return:
+        """
+        if self._ready.is_set():
+            logger.info(f"oppo handshake again, reason: {reason}")
+        self._ready.clear()
+        self._handshake_wakeup.set()
 
-    def _wait_for_get_device_list(self):
+    def _handshake_loop(self):
         """
-        等待获取所有协议和目录
+        握手状态机: 等待握手请求, 完成UDP开启HTTP、登录和获取设备列表后进入ready;
+        失败则进入offline并按指数退避重试, 直到播放机重新上线
         :return:
         """
+        retry_delay = 2
         while True:
+            self._handshake_wakeup.wait()
+            self._handshake_wakeup.clear()
+            ready = False
             try:
                 if self._open_oppo_http() is True and self._sign_in() is True:
                     device_list = self._get_device_list()
                     if device_list is not None and len(device_list) > 0:
                         self._device_list = device_list
+                    ready = True
             except Exception as e:
-                logger.error(f"get device_list exception, error: {e}")
-            finally:
-                time.sleep(5)
+                logger.error(f"oppo handshake exception, error: {e}")
+            if ready:
+                retry_delay = 2
+                # 先放行等待中的播放, 核对挂载只会让之后的播放重新挂载, 不需要阻塞播放
+                self._ready.set()
+                logger.info("oppo is ready")
+                self._reconcile_mount()
+                continue
+            # 播放机离线(关机或重启), 之前的挂载已不存在
+            self._invalidate_mount("player offline")
+            # 等待后重试, 期间收到新的握手请求立即重试
+            self._handshake_wakeup.wait(retry_delay)
+            self._handshake_wakeup.set()
+            retry_delay = min(retry_delay * 2, self.HANDSHAKE_MAX_RETRY_DELAY)
+
+    def _wait_ready(self):
+        """
+        等待握手完成并确认播放机可以访问
+        :return:
+        """
+        if self._ready.wait(self._udp_timeout) and self.is_online():
+            return True
+        # 握手后仍然无法访问, 可能刚刚断电重启, 再握手一次
+        self._request_handshake("player unreachable")
+        return self._ready.wait(self._udp_timeout) and self.is_online()
 
     def start_before(self, **kwargs):
         """
@@ -524,36 +498,19 @@ class Oppo(Player):
                     mapping_path["NFS"] += "/"
                 if self._use_nfs is not True and mapping_path["SMB"][-1] != "/":
                     mapping_path["SMB"] += "/"
-        thread = threading.Thread(target=self._wait_for_get_device_list)
+        self._snapshot_plan_version()
+        thread = threading.Thread(target=self._handshake_loop, name="oppo-handshake")
         thread.daemon = True
         thread.start()
+        self._request_handshake("startup")
 
-    def play(self, media_path: str, container, on_message, on_play_begin, on_play_in_progress, on_play_end, **kwargs):
+    def resolve_plan(self, media_path: str, container: str):
         """
-        播放影片
+        转换目录, 计算播放计划
         :param media_path:
         :param container:
-        :param on_message:
-        :param on_play_begin:
-        :param on_play_in_progress:
-        :param on_play_end:
-        :param kwargs:
         :return:
         """
-
-        # 检查设备是否在线，如果离线则不执行HDMI切换
-        if not self.is_online():
-            logger.warning("Oppo设备离线，跳过HDMI切换")
-            return on_message("Error", "Oppo设备离线，无法播放")
-        
-        # 提前切换HDMI（如果配置允许）
-        if self._switch_hdmi_before_play:
-            self._on_play_begin = on_play_begin
-            self._on_play_begin()
-
-        if self._play_status >= 0:
-            return on_message("Notification", "movie is playing or prepare to playing, wait!")
-        # 转换目录
         media_path = (media_path.replace('\\\\', '\\').
                       replace("\\", "/").replace("//", "/"))
         real_path = media_path
@@ -569,42 +526,238 @@ class Oppo(Player):
             file = file.lstrip("/")
             folder = self._force_mount_path
         logger.debug("curt path, sever: {}, folder:  {}, file: {}".format(sever, folder, file))
-        if self._use_nfs is True:
-            login_result = self._login_nfs(sever)
-            if login_result is not True:
-                return on_message("Error", "cannot login nfs, {}".format(login_result))
-            mount_result = self._mount_nfs_shared_folder(sever, folder)
-            if mount_result is not True:
-                return on_message("Error", "cannot mount nfs folder, {}".format(mount_result))
-        else:
-            login_result = self._login_samba_with_out_id(sever)
-            if login_result is not True:
-                return on_message("Error", "cannot login smb, {}".format(login_result))
-            used_key = None
-            mount_info = ''
-            for auth_item in self._auth:
-                mount_result = self._mount_shared_folder(sever, folder, auth_item["Username"], auth_item["Password"])
-                if mount_result is True:
-                    used_key = auth_item
-                    break
-                else:
-                    mount_info += ", " + str(mount_result)
-            if used_key is None:
-                return on_message("Error", "cannot mount smb folder{}".format(mount_info))
-            # 用过的key移到队尾
-            self._auth.remove(used_key)
-            self._auth.append(used_key)
-        if container != "bluray":
-            if not self._play_normal_file(self._use_nfs, file):
-                return on_message("Error", "cannot play normal file, {}".format(media_path))
-        else:
-            if not self._check_folder_has_bdmv(self._use_nfs, file):
-                return on_message("Error", "cannot play bdmv folder, {}".format(media_path))
-        # 开始播放并监控播放进度
-        self._on_message = on_message
-        self._on_play_begin = on_play_begin
-        self._on_play_in_progress = on_play_in_progress
-        self._on_play_end = on_play_end
-        thread = threading.Thread(target=self._track_play_status)
-        thread.daemon = True
-        thread.start()
\ No newline at end of file
+        return {
+            "protocol": "nfs" if self._use_nfs else "smb",
+            "server": sever,
+            "folder": folder,
+            "file": file,
+            "kind": "file" if container != "bluray" else "bdmv",
+        }
+
+    def _mount(self, plan):
+        """
+        登录并挂载播放计划中的共享目录
+        :param plan:
+        :return: 失败原因, 成功返回None
+        """
+        sever, folder = plan["server"], plan["folder"]
+        with self._mount_lock:
+            mount_key = (plan["protocol"], sever, folder)
+            if self._mounted == mount_key:
+                logger.debug(f"already mounted, skip login and mount, server: {sever}, folder: {folder}")
+                return None
+            self._mounted = None
+            if self._use_nfs is True:
+                login_result = self._login_nfs(sever)
+                if login_result is not True:
+                    return "cannot login nfs, {}".format(login_result)
+                mount_result = self._mount_nfs_shared_folder(sever, folder)
+                if mount_result is not True:
+                    return "cannot mount nfs folder, {}".format(mount_result)
+            else:
+                login_result = self._login_samba_with_out_id(sever)
+                if login_result is not True:
+                    return "cannot login smb, {}".format(login_result)
+                used_key = None
+                mount_info = ''
+                # 先尝试该目录上次成功的账号, 失败后按配置顺序尝试其他账号
+                share_key = "{}|{}".format(sever, folder)
+                last_auth_key = self._smb_auth_map.get(share_key)
+                auth_items = sorted(self._auth, key=lambda auth_item: self._auth_key(auth_item) != last_auth_key)
+                for auth_item in auth_items:
+                    mount_result = self._mount_shared_folder(sever, folder, auth_item["Username"],
+                                                             auth_item["Password"])
+                    if mount_result is True:
+                        used_key = auth_item
+                        break
+                    else:
+                        mount_info += ", " + str(mount_result)
+                if used_key is None:
+                    return "cannot mount smb folder{}".format(mount_info)
+                used_auth_key = self._auth_key(used_key)
+                if used_auth_key != last_auth_key:
+                    self._smb_auth_map[share_key] = used_auth_key
+                    self._save_smb_auth()
+            self._mounted = mount_key
+        return None
+
+    @staticmethod
+    def _auth_key(auth_item):
+        """
+        账号的标识, 同一用户名不同密码的账号也能区分, 保存到文件时不包含明文密码
+        :param auth_item:
+        :return:
+        """
+        content = "{}\0{}".format(auth_item["Username"], auth_item["Password"])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def _load_smb_auth(self):
+        """
+        读取保存的smb共享目录 -> 账号标识
+        :return:
+        """
+        if not os.path.exists(self._smb_auth_path):
+            return {}
+        try:
+            with open(self._smb_auth_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except Exception as e:
+            logger.error(f"load smb auth map error: {e}")
+        return {}
+
+    def _save_smb_auth(self):
+        try:
+            temp_path = self._smb_auth_path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(self._smb_auth_map, file)
+            os.replace(temp_path, self._smb_auth_path)
+        except Exception as e:
+            logger.error(f"save smb auth map error: {e}")
+
+    def _invalidate_mount(self, reason):
+        """
+        挂载状态失效, 下次播放重新登录和挂载
+        :param reason:
+        :return:
+        """
+        with self._mount_lock:
+            if self._mounted is not None:
+                logger.debug(f"mount state invalidated, reason: {reason}")
+            self._mounted = None
+
+    def _reconcile_mount(self):
+        """
+        与播放机上的共享目录列表核对挂载状态, 目录已不在列表中时失效
+        :return:
+        """
+        mounted = self._mounted
+        if mounted is None or not self._playback.is_idle():
+            return
+        share_folders = self._get_nfs_share_folder_list() if mounted[0] == "nfs" \
+            else self._get_samba_share_folder_list()
+        folder = mounted[2].strip("/")
+        if not share_folders or not any(folder.startswith(share_folder["folder"].strip("/"))
+                                        for share_folder in share_folders):
+            with self._mount_lock:
+                # 核对期间已经开始的播放可能重新挂载过, 只让核对的那次挂载失效
+                if self._mounted == mounted:
+                    logger.debug("mount state invalidated, reason: share folder is gone")
+                    self._mounted = None
+
+    def prepare(self, plan: dict):
+        """
+        记录下一部可能播放的影片, 空闲时提前挂载它的共享目录(播放中挂载会打断播放, 留到播放结束后)
+        :param plan:
+        :return:
+        """
+        self._prepared_plan = plan
+        if self._playback.is_idle():
+            self._mount_prepared()
+
+    def _mount_prepared(self):
+        """
+        后台挂载预先准备的共享目录
+        :return:
+        """
+        plan = self._prepared_plan
+        self._prepared_plan = None
+        if plan is None:
+            return
+
+        def mount():
+            mount_error = self._mount(plan)
+            if mount_error is not None:
+                logger.debug(f"prepare mount failed, {mount_error}")
+            else:
+                logger.debug(f"prepare mount successfully, server: {plan['server']}, folder: {plan['folder']}")
+
+        threading.Thread(target=mount, daemon=True).start()
+
+    def _play_plan(self, plan):
+        """
+        播放已挂载目录中的文件或蓝光目录
+        :param plan:
+        :return:
+        """
+        if plan["kind"] == "file":
+            return self._play_normal_file(self._use_nfs, plan["file"])
+        return self._check_folder_has_bdmv(self._use_nfs, plan["file"])
+
+    def _mount_and_play(self, plan, media_path):
+        """
+        挂载并播放
+        :param plan:
+        :param media_path:
+        :return: 失败原因, 成功返回None
+        """
+        mount_cached = self._mounted == (plan["protocol"], plan["server"], plan["folder"])
+        mount_error = self._mount(plan)
+        if mount_error is not None:
+            return mount_error
+        played = self._play_plan(plan)
+        if not played and mount_cached:
+            # 记录的挂载可能已失效, 重新登录挂载后再试一次
+            self._invalidate_mount("play failed")
+            mount_error = self._mount(plan)
+            if mount_error is not None:
+                return mount_error
+            played = self._play_plan(plan)
+        if not played:
+            if plan["kind"] == "file":
+                return "cannot play normal file, {}".format(media_path)
+            return "cannot play bdmv folder, {}".format(media_path)
+        return None
+
+    def _run_play_begin(self, on_play_begin):
+        """
+        执行播放开始事件(切换电视、功放)
+        :param on_play_begin:
+        :return:
+        """
+        try:
+            on_play_begin()
+        except Exception as e:
+            logger.error(f"play begin exception, error: {e}")
+
+    def play(self, media_path: str, container, on_message, on_play_begin, on_play_in_progress, on_play_end, **kwargs):
+        """
+        播放影片
+        :param media_path:
+        :param container:
+        :param on_message:
+        :param on_play_begin:
+        :param on_play_in_progress:
+        :param on_play_end:
+        :param kwargs:
+        :return:
+        """
+
+        # 检查设备是否在线，如果离线则不执行HDMI切换
+        if not self._wait_ready():
+            logger.warning("Oppo设备离线，跳过HDMI切换")
+            return on_message("Error", "Oppo设备离线，无法播放")
+        
+        if not self._playback.claim():
+            return on_message("Notification", "movie is playing or prepare to playing, wait!")
+        # 提前切换HDMI（如果配置允许）, 与登录、挂载、播放同时进行
+        begin_thread = None
+        if self._switch_hdmi_before_play:
+            begin_thread = threading.Thread(target=self._run_play_begin, args=(on_play_begin,),
+                                            name="oppo-play-begin")
+            begin_thread.daemon = True
+            begin_thread.start()
+        try:
+            plan = kwargs.get("plan") or self.resolve_plan(media_path, container)
+            error = self._mount_and_play(plan, media_path)
+        except Exception:
+            self._playback.abort()
+            raise
+        if error is not None:
+            self._playback.abort()
+            return on_message("Error", error)
+        # 等待HDMI切换完成, 保证开始事件先于进度和结束事件
+        if begin_thread is not None:
+            begin_thread.join()
+        # 开始播放并由监控线程跟踪播放进度
+        self._playback.start(on_play_begin, on_play_in_progress, on_play_end,
+                             begin_reported=self._switch_hdmi_before_play)
\ No newline at end of file
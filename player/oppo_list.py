@@ -0,0 +1,80 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version
+"""
+
+from typing import Iterator, List
+
+
+def iter_list_entries(content: bytes) -> Iterator[str]:
+    """
+    逐个解析oppo列表接口返回的名称(共享目录列表/文件列表)
+    格式: 每项以\\x01分隔, 包含\\x02的是头部信息, 名称为项内最后一个\\x00之后的内容
+    只在原始数据上查找分隔符, 名称直接从memoryview解码, 不产生中间拷贝
+    :param content:
+    :return:
+    """
+    view = memoryview(content)
+    total = len(content)
+    start = 0
+    while start <= total:
+        end = content.find(b'\x01', start)
+        if end == -1:
+            end = total
+        if content.find(b'\x02', start, end) == -1:
+            separator = content.rfind(b'\x00', start, end)
+            name_start = separator + 1 if separator != -1 else start
+            if name_start < end:
+                yield str(view[name_start:end], 'utf-8')
+        start = end + 1
+
+
+def parse_list(content: bytes) -> List[dict]:
+    """
+    解析oppo列表接口返回的内容
+    :param content:
+    :return: [{"id": 序号(从1开始), "folder": 名称}]
+    """
+    return [{"id": num, "folder": name} for num, name in enumerate(iter_list_entries(content), 1)]
+
+
+if __name__ == '__main__':
+    # 性能对比: python -m player.oppo_list
+    import timeit
+
+    def legacy_parse_list(content):
+        b = content.rsplit(b'\x01')
+        files = []
+        num = 1
+        for c in b:
+            if c.find(b'\x02') == -1:
+                index = 0
+                ult = 0
+                d = c
+                while index != -1:
+                    index = c.find(b'\x00', index)
+                    if index == -1:
+                        d = d[ult:]
+                    else:
+                        ult = index + 1
+                        index = index + 1
+                e = d.decode('utf-8')
+                if e != '':
+                    file = {"id": num, "folder": e}
+                    num = num + 1
+                    files.append(file)
+        return files
+
+    for count in (100, 10000, 100000):
+        entries = [b'\x00\x00%d\x00\x00Movie %06d (2024) [BluRay 2160p].mkv' % (i % 3, i) for i in range(count)]
+        listing = b'\x02header\x02' + b'\x01' + b'\x01'.join(entries)
+        assert parse_list(listing) == legacy_parse_list(listing)
+        number = max(1, 200000 // count)
+        legacy = timeit.timeit(lambda: legacy_parse_list(listing), number=number) / number
+        current = timeit.timeit(lambda: parse_list(listing), number=number) / number
+        print(f"{count:>7} entries: legacy {legacy * 1000:8.2f}ms, "
+              f"memoryview {current * 1000:8.2f}ms, speedup {legacy / current:.2f}x")
@@ -6,6 +6,7 @@ import json
 import threading
 import urllib.parse
 from abstract_classes import Player, PlayerException
+from player.playback import PlaybackSession
 
 
 logger = logging.getLogger(__name__)
@@ -38,10 +39,6 @@ class Pioneer(Player):
             self._online_status = 1
             self._offline_count = 0
 
-            self._on_message = None
-            self._on_play_begin = None
-            self._on_play_in_progress = None
-            self._on_play_end = None
             self._headers = {
                 "Authorization": "Basic dmlzaW86dmlzaW8=",
                 "Content-Type": "application/json",
@@ -57,9 +54,11 @@ class Pioneer(Player):
                 "home": 585730,
             }
 
-            self._position_ticks = 0
-            self._total_ticks = 0
-            self._play_status = -1
+            # 播放会话由共用的监控线程跟踪
+            self._playback = PlaybackSession("pioneer", self._query_play_status, 1000000,
+                                             fast_interval=self._config.get('PollInterval', 1),
+                                             slow_interval=self._config.get('PollSlowInterval', 10),
+                                             failure_timeout=20, start_timeout=20)
 
             thread = threading.Thread(target=self._track_online_status)
             thread.daemon = True
@@ -173,67 +172,30 @@ class Pioneer(Player):
                         self._offline_count = 0
                         logger.debug("set online status to 0")
 
-    def _track_play_status(self):
+    def _query_play_status(self):
         """
-        跟踪播放进度
+        查询播放状态和进度
         :return:
         """
-
-        self._play_status = 0
-        last_qry_time = time.time()
-        last_report_time = 0
-        timeout = 20
-
-        while True:
-            time.sleep(1)
-            play_info = self._get_play_info()
-            logger.debug(play_info)
-            if play_info is None:
-                if time.time() - last_qry_time > timeout:
-                    break
-                else:
-                    continue
-            if self._play_status == 0:
-                if "elapsetime" in play_info["result"]:
-                    self._play_status = 1
-                    logger.debug("set playing status to 1")
-                    # 如果未在开始时切换HDMI，则在此处切换
-                    if not self._switch_hdmi_before_play:
-                        self._on_play_begin()
-                elif time.time() - last_qry_time > timeout:
-                    break
-                else:
-                    continue
-            elif self._play_status == 1:
-                if "elapsetime" in play_info["result"]:
-                    if time.time() - last_report_time > 60:
-                        elapse_hours = play_info["result"]["elapsetime"]["hours"]
-                        elapse_minutes = play_info["result"]["elapsetime"]["minutes"]
-                        elapse_seconds = play_info["result"]["elapsetime"]["seconds"]
-                        elapse_milliseconds = play_info["result"]["elapsetime"]["milliseconds"]
-
-                        total_hours = play_info["result"]["totaltime"]["hours"]
-                        total_minutes = play_info["result"]["totaltime"]["minutes"]
-                        total_seconds = play_info["result"]["totaltime"]["seconds"]
-                        total_milliseconds = play_info["result"]["totaltime"]["milliseconds"]
-
-                        self._position_ticks = elapse_hours * 3600000000 + elapse_minutes * 60000000 + elapse_seconds * 1000000 + elapse_milliseconds * 1000
-                        self._total_ticks = total_hours * 3600000000 + total_minutes * 60000000 + total_seconds * 1000000 + total_milliseconds * 1000
-
-                        self._on_play_in_progress(position_ticks=self._position_ticks, total_ticks=self._total_ticks)
-                        last_report_time = time.time()
-                        logger.debug("update play position ticks: {}".format(self._position_ticks))
-
-                else:
-                    logger.debug("play end break")
-                    break
-            last_qry_time = time.time()
-        # 报告已结束
-        self._on_play_end(position_ticks=self._position_ticks, total_ticks=self._total_ticks)
-        logger.debug("play end")
-        self._position_ticks = 0
-        self._total_ticks = 0
-        self._play_status = -1
+        play_info = self._get_play_info()
+        logger.debug(play_info)
+        if play_info is None:
+            return None
+        if "elapsetime" not in play_info["result"]:
+            return {"playing": False}
+        elapse_hours = play_info["result"]["elapsetime"]["hours"]
+        elapse_minutes = play_info["result"]["elapsetime"]["minutes"]
+        elapse_seconds = play_info["result"]["elapsetime"]["seconds"]
+        elapse_milliseconds = play_info["result"]["elapsetime"]["milliseconds"]
+
+        total_hours = play_info["result"]["totaltime"]["hours"]
+        total_minutes = play_info["result"]["totaltime"]["minutes"]
+        total_seconds = play_info["result"]["totaltime"]["seconds"]
+        total_milliseconds = play_info["result"]["totaltime"]["milliseconds"]
+
+        position_ticks = elapse_hours * 3600000000 + elapse_minutes * 60000000 + elapse_seconds * 1000000 + elapse_milliseconds * 1000
+        total_ticks = total_hours * 3600000000 + total_minutes * 60000000 + total_seconds * 1000000 + total_milliseconds * 1000
+        return {"playing": True, "position": position_ticks, "total": total_ticks}
 
     def _play(self, nfs_prefer, path, play_type, matched_mapping=None):
         """
@@ -307,34 +269,15 @@ class Pioneer(Player):
         启动前
         :return:
         """
-        pass
+        self._snapshot_plan_version()
 
-    def play(self, media_path: str, container, on_message, on_play_begin, on_play_in_progress, on_play_end, **kwargs):
+    def resolve_plan(self, media_path: str, container: str):
         """
-        播放影片
+        转换目录, 计算播放计划
         :param media_path:
         :param container:
-        :param on_message:
-        :param on_play_begin:
-        :param on_play_in_progress:
-        :param on_play_end:
-        :param kwargs:
         :return:
         """
-
-        # 检查设备是否在线，如果离线则不执行HDMI切换
-        if not self.is_online():
-            logger.warning("Pioneer设备离线，跳过HDMI切换")
-            return on_message("Error", "Pioneer设备离线，无法播放")
-        
-        # 提前切换HDMI（如果配置允许）
-        if self._switch_hdmi_before_play:
-            self._on_play_begin = on_play_begin
-            self._on_play_begin()
-
-        if self._play_status >= 0:
-            return on_message("Notification", "movie is playing or prepare to playing, wait!")
-        # 转换目录
         media_path = (media_path.replace('\\\\', '\\').
                       replace("\\", "/").replace("//", "/"))
         real_path = media_path
@@ -353,17 +296,49 @@ class Pioneer(Player):
         logger.debug("transfer path, from: {}, to: {}".format(media_path, real_path))
         sever, folder, file = self.extract_path_parts(real_path)
         logger.debug("curt path, sever: {}, folder:  {}, file: {}".format(sever, folder, file))
-        if container != "bluray" and not file.lower().endswith(".iso"):
-            if not self._play(self._use_nfs, folder+"/"+file, self.VIDEO, matched_mapping):
-                return on_message("Error", "cannot play bdmv folder, {}".format(media_path))
-        else:
-            if not self._play(self._use_nfs, folder+"/"+file, self.BDMV, matched_mapping):
-                return on_message("Error", "cannot play bdmv folder, {}".format(media_path))
-        # 开始播放并监控播放进度
-        self._on_message = on_message
-        self._on_play_begin = on_play_begin
-        self._on_play_in_progress = on_play_in_progress
-        self._on_play_end = on_play_end
-        thread = threading.Thread(target=self._track_play_status)
-        thread.daemon = True
-        thread.start()
\ No newline at end of file
+        return {
+            "protocol": "nfs" if self._use_nfs else "smb",
+            "server": sever,
+            "folder": folder,
+            "file": file,
+            "kind": "file" if container != "bluray" and not file.lower().endswith(".iso") else "bdmv",
+            "mapping": matched_mapping,
+        }
+
+    def play(self, media_path: str, container, on_message, on_play_begin, on_play_in_progress, on_play_end, **kwargs):
+        """
+        播放影片
+        :param media_path:
+        :param container:
+        :param on_message:
+        :param on_play_begin:
+        :param on_play_in_progress:
+        :param on_play_end:
+        :param kwargs:
+        :return:
+        """
+
+        # 检查设备是否在线，如果离线则不执行HDMI切换
+        if not self.is_online():
+            logger.warning("Pioneer设备离线，跳过HDMI切换")
+            return on_message("Error", "Pioneer设备离线，无法播放")
+        
+        if not self._playback.claim():
+            return on_message("Notification", "movie is playing or prepare to playing, wait!")
+        try:
+            # 提前切换HDMI（如果配置允许）
+            if self._switch_hdmi_before_play:
+                on_play_begin()
+            plan = kwargs.get("plan") or self.resolve_plan(media_path, container)
+            path = plan["folder"] + "/" + plan["file"]
+            play_type = self.VIDEO if plan["kind"] == "file" else self.BDMV
+            played = self._play(self._use_nfs, path, play_type, plan["mapping"])
+        except Exception:
+            self._playback.abort()
+            raise
+        if not played:
+            self._playback.abort()
+            return on_message("Error", "cannot play bdmv folder, {}".format(media_path))
+        # 开始播放并由监控线程跟踪播放进度
+        self._playback.start(on_play_begin, on_play_in_progress, on_play_end,
+                             begin_reported=self._switch_hdmi_before_play)
\ No newline at end of file
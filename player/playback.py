@@ -0,0 +1,324 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, Optional
+from player.poll_schedule import PollSchedule
+
+logger = logging.getLogger(__name__)
+
+
+class PlaybackSession(object):
+    """
+    播放会话状态机, 每个播放器一个, 重复使用
+    idle -> preparing(play()占用, 登录挂载中) -> starting(已发送播放命令, 等待开始) -> playing -> idle
+    preparing 失败直接回到 idle; 状态切换加锁, 回调在锁外执行
+    """
+    IDLE = "idle"
+    PREPARING = "preparing"
+    STARTING = "starting"
+    PLAYING = "playing"
+    TRANSITIONS = {
+        IDLE: {PREPARING},
+        PREPARING: {STARTING, IDLE},
+        STARTING: {PLAYING, IDLE},
+        PLAYING: {IDLE},
+    }
+    # 回调上报的进度单位(与emby一致, 每秒10000000), 与播放器的进度单位不同时换算
+    REPORT_TICKS_PER_SECOND = 10000000
+
+    def __init__(self, name: str, query_status: Callable[[], Optional[dict]], ticks_per_second: int,
+                 fast_interval: float = 1, slow_interval: float = 10, failure_timeout: float = 5,
+                 start_timeout: float = None, report_interval: float = 60,
+                 sample_progress: Callable[[], Optional[tuple]] = None,
+                 on_lost: Callable[[], None] = None, on_finished: Callable[[], None] = None):
+        """
+        :param name: 日志中的名称
+        :param query_status: 查询播放器状态, 失败返回None,
+                             成功返回 {"playing": bool, "position": ticks, "total": ticks}, position/total 可以为None
+        :param ticks_per_second: 播放器进度单位, 回调时换算为 REPORT_TICKS_PER_SECOND
+        :param fast_interval: 快速轮询间隔(秒)
+        :param slow_interval: 慢速轮询间隔(秒)
+        :param failure_timeout: 连续查询失败多久(秒)视为播放机丢失, 结束会话
+        :param start_timeout: 发送播放命令后多久(秒)还未开始播放则结束会话, None为一直等待
+        :param report_interval: 进度上报间隔(秒)
+        :param sample_progress: 上报进度前采样 (position, total), query_status 不返回进度的播放器使用
+        :param on_lost: 播放机丢失时调用
+        :param on_finished: 会话结束(回到idle)后调用
+        """
+        self._name = name
+        self._query_status = query_status
+        self._ticks_per_second = ticks_per_second
+        self._fast_interval = fast_interval
+        self._slow_interval = slow_interval
+        self._failure_timeout = failure_timeout
+        self._start_timeout = start_timeout
+        self._report_interval = report_interval
+        self._sample_progress = sample_progress
+        self._on_lost = on_lost
+        self._on_finished = on_finished
+        self._lock = threading.Lock()
+        self._state = self.IDLE
+        self._timestamps = {}
+        self._callbacks = None
+        self._begin_reported = False
+        self._schedule = None
+        self._next_poll_at = None
+        self._failed_since = None
+        self._reported_at = None
+        self._position = 0
+        self._total = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def is_idle(self):
+        return self.state == self.IDLE
+
+    def _transition(self, state):
+        """
+        切换状态并记录时间, 调用方持有锁
+        :param state:
+        :return:
+        """
+        if state not in self.TRANSITIONS[self._state]:
+            raise ValueError(f"{self._name} playback cannot change from {self._state} to {state}")
+        now = time.monotonic()
+        previous = self._timestamps.get(self._state)
+        logger.debug(f"{self._name} playback {self._state} -> {state}"
+                     + (f" after {now - previous:.1f}s" if previous is not None else ""))
+        self._state = state
+        self._timestamps[state] = now
+
+    def claim(self):
+        """
+        play()开始前占用会话, 已在播放或准备播放时返回False
+        :return:
+        """
+        with self._lock:
+            if self._state != self.IDLE:
+                return False
+            self._timestamps = {}
+            self._transition(self.PREPARING)
+            return True
+
+    def abort(self):
+        """
+        准备播放失败, 释放会话
+        :return:
+        """
+        with self._lock:
+            if self._state == self.PREPARING:
+                self._transition(self.IDLE)
+
+    def start(self, on_play_begin, on_play_in_progress, on_play_end, begin_reported: bool = False):
+        """
+        已发送播放命令, 交给监控线程跟踪
+        :param on_play_begin:
+        :param on_play_in_progress:
+        :param on_play_end:
+        :param begin_reported: 是否已经调用过开始事件(提前切换HDMI)
+        :return:
+        """
+        with self._lock:
+            self._transition(self.STARTING)
+            self._callbacks = (on_play_begin, on_play_in_progress, on_play_end)
+            self._begin_reported = begin_reported
+            self._schedule = PollSchedule(self._ticks_per_second, fast_interval=self._fast_interval,
+                                          slow_interval=self._slow_interval)
+            self._failed_since = None
+            self._reported_at = None
+            self._position = 0
+            self._total = 0
+            self._next_poll_at = time.monotonic() + self._fast_interval
+        PlaybackMonitor.shared().add(self)
+
+    def due_at(self):
+        """
+        下次轮询时间, 不需要轮询时返回None
+        :return:
+        """
+        with self._lock:
+            if self._state not in (self.STARTING, self.PLAYING):
+                return None
+            return self._next_poll_at
+
+    def poll(self):
+        """
+        监控线程调用: 查询一次播放器状态并推进状态机
+        :return:
+        """
+        with self._lock:
+            # 先按快速间隔排期, 查询异常时也不会卡住
+            self._next_poll_at = time.monotonic() + self._fast_interval
+        status = self._query_status()
+        now = time.monotonic()
+        begin = False
+        report = False
+        finish = None
+        with self._lock:
+            if self._state not in (self.STARTING, self.PLAYING):
+                return
+            if status is None:
+                # 从第一次查询失败开始计时, 慢速轮询时上次成功的查询可能已经过去很久
+                if self._failed_since is None:
+                    self._failed_since = now
+                elif now - self._failed_since > self._failure_timeout:
+                    finish = "lost"
+            else:
+                self._failed_since = None
+                if self._state == self.STARTING:
+                    if status["playing"]:
+                        self._transition(self.PLAYING)
+                        self._schedule.start()
+                        begin = not self._begin_reported
+                    elif (self._start_timeout is not None
+                          and now - self._timestamps[self.STARTING] > self._start_timeout):
+                        finish = "start timeout"
+                elif status["playing"]:
+                    self._schedule.playing()
+                    if status.get("position") is not None:
+                        self._sample(status["position"], status.get("total") or 0)
+                    report = self._reported_at is None or now - self._reported_at > self._report_interval
+                    if report:
+                        self._reported_at = now
+                else:
+                    finish = "stopped"
+            if finish is None:
+                self._next_poll_at = time.monotonic() + (
+                    self._schedule.next_interval() if self._state == self.PLAYING else self._fast_interval)
+            on_play_begin, on_play_in_progress, on_play_end = self._callbacks
+        if begin:
+            on_play_begin()
+        if report:
+            if self._sample_progress is not None:
+                progress = self._sample_progress()
+                if progress is not None:
+                    with self._lock:
+                        self._sample(*progress)
+            with self._lock:
+                position, total = self._position, self._total
+            on_play_in_progress(position_ticks=self._report_ticks(position), total_ticks=self._report_ticks(total))
+            logger.debug(f"{self._name} update play position ticks: {position}")
+        if finish is not None:
+            self._finish(finish, on_play_end)
+
+    def _sample(self, position, total):
+        """
+        记录采样到的进度, 调用方持有锁
+        :param position:
+        :param total:
+        :return:
+        """
+        if position > 0:
+            self._position = position
+        if total > 0:
+            self._total = total
+        self._schedule.sample(self._position, self._total)
+
+    def _report_ticks(self, ticks):
+        """
+        播放器进度换算为回调的进度单位
+        :param ticks:
+        :return:
+        """
+        return ticks * self.REPORT_TICKS_PER_SECOND // self._ticks_per_second
+
+    def _finish(self, reason, on_play_end):
+        """
+        结束会话: 按最后确认播放的时间推算结束位置, 回到idle后报告结束
+        :param reason:
+        :param on_play_end:
+        :return:
+        """
+        with self._lock:
+            if self._state == self.PLAYING:
+                self._position = self._schedule.estimate()
+            position, total = self._position, self._total
+            self._transition(self.IDLE)
+            self._callbacks = None
+            self._next_poll_at = None
+        logger.info(f"{self._name} playback ended, reason: {reason}")
+        try:
+            on_play_end(position_ticks=self._report_ticks(position), total_ticks=self._report_ticks(total))
+        finally:
+            if reason == "lost" and self._on_lost is not None:
+                self._on_lost()
+            if self._on_finished is not None:
+                self._on_finished()
+
+
+class PlaybackMonitor(object):
+    """
+    常驻的播放监控线程, 按各会话的轮询计划依次查询, 没有播放时阻塞等待
+    只持有正在跟踪的会话, 会话结束后即释放
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """
+        所有播放器共用的监控线程
+        :return:
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = PlaybackMonitor()
+            return cls._shared
+
+    def __init__(self):
+        self._sessions = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="player-monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, session: PlaybackSession):
+        """
+        开始跟踪会话
+        :param session:
+        :return:
+        """
+        with self._cond:
+            if session not in self._sessions:
+                self._sessions.append(session)
+            self._cond.notify()
+
+    def _next_session(self):
+        with self._cond:
+            while True:
+                due_sessions = []
+                for session in list(self._sessions):
+                    due_at = session.due_at()
+                    if due_at is None:
+                        self._sessions.remove(session)
+                    else:
+                        due_sessions.append((due_at, session))
+                if len(due_sessions) <= 0:
+                    self._cond.wait()
+                    continue
+                due_at, session = min(due_sessions, key=lambda due_session: due_session[0])
+                wait_time = due_at - time.monotonic()
+                if wait_time > 0:
+                    self._cond.wait(wait_time)
+                    continue
+                return session
+
+    def _run(self):
+        while True:
+            session = self._next_session()
+            try:
+                session.poll()
+            except Exception as e:
+                logger.error(f"Exception during track play status: {e}")
@@ -0,0 +1,90 @@
+"""
+Copyright (C) 2025 whitebrise
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version
+"""
+
+import time
+
+
+class PollSchedule(object):
+    """
+    自适应轮询: 刚开始播放和接近结尾时快速轮询, 影片中段慢速轮询, 两次采样之间推算播放位置
+    """
+    def __init__(self, ticks_per_second: int, fast_interval: float = 1, slow_interval: float = 10,
+                 start_window: float = 60, end_window: float = 120):
+        """
+        :param ticks_per_second: 播放器进度单位
+        :param fast_interval: 快速轮询间隔(秒)
+        :param slow_interval: 慢速轮询间隔(秒)
+        :param start_window: 开始播放后快速轮询的时长(秒)
+        :param end_window: 距离结尾多少秒开始快速轮询
+        """
+        self.fast_interval = fast_interval
+        self._ticks_per_second = ticks_per_second
+        self._slow_interval = max(slow_interval, fast_interval)
+        self._start_window = start_window
+        self._end_window = end_window
+        self._started_at = None
+        self._position = 0
+        self._total = 0
+        self._sampled_at = None
+        self._playing_at = None
+
+    def start(self):
+        """
+        检测到开始播放
+        :return:
+        """
+        self._started_at = time.monotonic()
+        self._playing_at = self._started_at
+
+    def playing(self):
+        """
+        本次轮询确认仍在播放
+        :return:
+        """
+        self._playing_at = time.monotonic()
+
+    def sample(self, position_ticks, total_ticks):
+        """
+        记录采样到的播放进度
+        :param position_ticks:
+        :param total_ticks:
+        :return:
+        """
+        self._position = position_ticks
+        if total_ticks > 0:
+            self._total = total_ticks
+        self._sampled_at = time.monotonic()
+
+    def estimate(self, at: float = None):
+        """
+        推算播放位置, 默认推算到最后一次确认播放的时间(播放结束时不会越过停止的位置)
+        :param at: time.monotonic() 时间
+        :return:
+        """
+        if self._sampled_at is None:
+            return self._position
+        at = at if at is not None else self._playing_at
+        position = self._position + int(max(0.0, at - self._sampled_at) * self._ticks_per_second)
+        if self._total > 0:
+            position = min(position, self._total)
+        return position
+
+    def next_interval(self):
+        """
+        下次轮询间隔
+        :return:
+        """
+        now = time.monotonic()
+        if self._started_at is None or now - self._started_at < self._start_window or self._total <= 0:
+            return self.fast_interval
+        remaining = (self._total - self.estimate(now)) / self._ticks_per_second
+        if remaining <= self._end_window:
+            return self.fast_interval
+        # 中段慢速轮询, 但不跨过结尾窗口
+        return max(self.fast_interval, min(self._slow_interval, remaining - self._end_window))